@@ -0,0 +1,124 @@
+from os import path, makedirs, replace
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
+
+from ma2_synatize import GLfloat
+
+
+@lru_cache(maxsize = 2)
+def float16Strings(formatter):
+    # every float16 has one of 65536 bit patterns, so formatting the whole sequence is just an index into this table
+    values = np.arange(1 << 16, dtype = np.uint16).view(np.float16).tolist()
+    return np.array([formatter(v) if np.isfinite(v) else str(v) for v in values], dtype = object)
+
+@lru_cache(maxsize = 1)
+def uint16Strings():
+    return np.array([str(v) for v in range(1 << 16)], dtype = object)
+
+
+class ArtifactEmitter:
+
+    # the files a build produces for the outside world: sequence.h, sfx.frag and <title>.glsl.
+    # nothing of it is needed for playing back, so build() only hands over its results; the texts are generated when
+    # somebody asks (emit() or the ...Text() functions) and written by a background thread, via a temporary file and a rename.
+
+    names = ['sequence', 'fragment', 'standalone']
+
+    def __init__(self, outdir = '.'):
+        self.outdir = outdir
+        self.executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'artifacts')
+        self.pending = []
+        self.clear()
+
+    def clear(self):
+        self.title = None
+        self.sequence = None
+        self.shaderCode = None
+        self.fragmentHeader = None
+        self.textureHeader = None
+        self.shaderHeader = None
+        self.cache = {}
+
+    def update(self, title, sequence, shaderCode, fragmentHeader, textureHeader, shaderHeader):
+        # sequence: the float16 (or float32) texture data, shaderCode: the purged template code, still with //TEXCODE and //TEXTUREHEADER
+        self.title = title
+        self.sequence = sequence
+        self.shaderCode = shaderCode
+        self.fragmentHeader = fragmentHeader
+        self.textureHeader = textureHeader
+        self.shaderHeader = shaderHeader
+        self.cache = {}
+
+    def saveState(self):
+        return (self.title, self.sequence, self.shaderCode, self.fragmentHeader, self.textureHeader, self.shaderHeader, self.cache)
+
+    def restoreState(self, state):
+        self.title, self.sequence, self.shaderCode, self.fragmentHeader, self.textureHeader, self.shaderHeader, self.cache = state
+
+    def ready(self):
+        return self.sequence is not None
+
+    def fileName(self, name):
+        return path.join(self.outdir, {'sequence': 'sequence.h', 'fragment': 'sfx.frag', 'standalone': self.title + '.glsl'}[name])
+
+    def text(self, name):
+        if name not in self.cache:
+            self.cache[name] = {'sequence': self.sequenceText, 'fragment': self.fragmentText, 'standalone': self.standaloneText}[name]()
+        return self.cache[name]
+
+    def sequenceStrings(self, formatter):
+        if self.sequence.dtype.itemsize == 2:
+            return float16Strings(formatter)[self.sequence.view(np.uint16)].tolist()
+        return list(map(formatter, self.sequence.tolist()))
+
+    def sequenceText(self):
+        tex_n = len(self.sequence)
+        tex_s = int(np.ceil(np.sqrt(self.sequence.nbytes / 4.)))
+        if self.sequence.dtype.itemsize == 2:
+            data = f"const unsigned short sequence_texture[{tex_n}] = {{" + ','.join(uint16Strings()[self.sequence.view(np.uint16)].tolist()) + "};\n"
+        else:
+            print("HINT: the sequence is float32, sequence.h does not match the RGBA8 layout of template.textureheader")
+            data = f"const float sequence_texture[{tex_n}] = {{" + ','.join(self.sequenceStrings(GLfloat)) + "};\n"
+        return ''.join([
+            "// Generated by tx210 / aMaySyn (c) 2018 NR4&QM/Team210\n\n#ifndef SEQUENCE_H\n#define SEQUENCE_H\n\n",
+            "// Data:\n//", ', '.join(self.sequenceStrings(str)), "\n",
+            data,
+            f"const int sequence_texture_size = {tex_s};",
+            "\n#endif\n",
+        ])
+
+    def fragmentText(self):
+        return self.fragmentHeader + self.shaderCode.replace("//TEXTUREHEADER", self.textureHeader)
+
+    def standaloneText(self):
+        tex_n = len(self.sequence)
+        texcode = f"const float sequence_texture[{tex_n}] = float[{tex_n}](" + ','.join(self.sequenceStrings(GLfloat)) + ");\n"
+        return (self.shaderHeader + self.shaderCode)\
+            .replace("//TEXCODE", texcode)\
+            .replace('//TEXTUREHEADER', 'float rfloat(int off){return sequence_texture[off];}\n')
+
+    def emit(self, names = None):
+        # generated right away (the build results might change in the meantime), written in the background
+        if not self.ready():
+            print("nothing built yet, no artifacts to write.")
+            return
+        for name in names or self.names:
+            self.pending.append(self.executor.submit(self.write, self.fileName(name), self.text(name)))
+        self.pending = [job for job in self.pending if not job.done()]
+
+    def write(self, filename, text):
+        try:
+            makedirs(path.dirname(filename) or '.', exist_ok = True)
+            with open(filename + '.tmp', 'w') as out_file:
+                out_file.write(text)
+            replace(filename + '.tmp', filename)
+        except OSError as e:
+            print("could not write", filename, e)
+            return
+        print("ARTIFACT WRITTEN (" + filename + ")")
+
+    def flush(self):
+        for job in self.pending:
+            job.result()
+        self.pending = []
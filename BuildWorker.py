@@ -0,0 +1,88 @@
+from PyQt5.QtCore import QThread, pyqtSignal
+from copy import deepcopy
+import threading
+
+
+class BuildCancelled(Exception):
+    pass
+
+
+class BuildWorker(QThread):
+
+    # runs aMaySynBuilder.build() off the GUI thread, on deep copies of tracks / patterns / info.
+    # there is only one pending request: a newer one replaces it, and cancels a build that is already running
+    # (at its next checkCancelled()). the GL part stays with the GUI, which gets the shader via built() and
+    # only touches the builder while it holds the lock (tryLock / unlock), so no build can run in between.
+
+    built = pyqtSignal(int, str)
+    failed = pyqtSignal(int, str)
+
+    def __init__(self, amaysyn, parent = None):
+        super().__init__(parent)
+        self.amaysyn = amaysyn
+        self.amaysyn.cancelled = self.isSuperseded
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.pending = None
+        self.generation = 0
+        self.running = None
+        self.stopping = False
+
+    def submit(self, tracks, patterns, info, floatOutput = None, extraTimeShift = 0):
+        request = deepcopy({'tracks': tracks, 'patterns': patterns, 'info': info, 'floatOutput': floatOutput, 'extraTimeShift': extraTimeShift})
+        with self.condition:
+            self.generation += 1
+            request['generation'] = self.generation
+            if self.pending is not None:
+                print(f"build {self.pending['generation']} dropped, there is a newer one")
+            self.pending = request
+            self.condition.notify()
+        if not self.isRunning():
+            self.start()
+        return request['generation']
+
+    def isLatest(self, generation):
+        return generation == self.generation
+
+    def isSuperseded(self):
+        # called from within build(). builds outside of this thread (running is None) are never cancelled
+        return self.stopping or (self.running is not None and self.running != self.generation)
+
+    def tryLock(self):
+        return self.lock.acquire(blocking = False)
+
+    def unlock(self):
+        self.lock.release()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                request, self.pending = self.pending, None
+
+            generation = request['generation']
+            with self.lock:
+                self.running = generation
+                try:
+                    self.amaysyn.info = request['info']
+                    self.amaysyn.extra_time_shift = request['extraTimeShift']
+                    shader = self.amaysyn.build(tracks = request['tracks'], patterns = request['patterns'], floatOutput = request['floatOutput'])
+                except BuildCancelled:
+                    print(f"build {generation} cancelled, there is a newer one")
+                    continue
+                except Exception as e:
+                    self.failed.emit(generation, f"{type(e).__name__}: {e}")
+                    continue
+                finally:
+                    self.running = None
+
+            self.built.emit(generation, shader)
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.wait()
@@ -1,25 +1,94 @@
 from PyQt5.QtCore import QObject, pyqtSignal
 from watchdog.events import FileSystemEventHandler
-from datetime import datetime, timedelta
+from os import path, stat
+from hashlib import sha1
+import threading
+import json
 
 
 class FileModifiedHandler(FileSystemEventHandler, QObject):
 
-    fileChanged = pyqtSignal()
+    # the aMaySyn exporter writes the .mayson several times per save. so this waits until there were no events for
+    # quietTime seconds (trailing edge) and size + mtime stayed the same, then reads and parses the file in the timer thread.
+    # fileChanged only fires if the bytes are different from the last time, with the parsed JSON (queued to the GUI thread).
 
-    def __init__(self, filename):
+    fileChanged = pyqtSignal(object)
+
+    def __init__(self, filename, quietTime = .5):
         super().__init__()
-        self.filename = filename
-        self.lastModTime = datetime.now()
+        self.filename = path.abspath(filename)
+        self.quietTime = quietTime
+        self.timer = None
+        self.lock = threading.Lock()
+        # whatever is there right now has just been imported
+        self.digest = self.readDigest()
+
+    def readDigest(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                return sha1(f.read()).hexdigest()
+        except OSError:
+            return None
+
+    def signature(self):
+        try:
+            info = stat(self.filename)
+        except OSError:
+            return None
+        return (info.st_size, info.st_mtime_ns)
 
     def on_modified(self, event):
-        if event.src_path != self.filename:
+        if not event.is_directory and path.abspath(event.src_path) == self.filename:
+            self.schedule()
+
+    def on_created(self, event):
+        self.on_modified(event)
+
+    def on_moved(self, event):
+        # editors that save via a temporary file and a rename
+        if not event.is_directory and path.abspath(event.dest_path) == self.filename:
+            self.schedule()
+
+    def schedule(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.quietTime, self.settle, args = (self.signature(),))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def cancel(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = None
+
+    def settle(self, lastSignature):
+        signature = self.signature()
+        if signature is None:
+            return
+        if signature != lastSignature:
+            # still being written, without telling us
+            self.schedule()
+            return
+
+        try:
+            with open(self.filename, 'rb') as f:
+                content = f.read()
+        except OSError:
+            return
+        digest = sha1(content).hexdigest()
+        if digest == self.digest:
+            print(self.filename, "saved, but nothing changed. no reimport.")
             return
 
-        if datetime.now() - self.lastModTime < timedelta(seconds = 1):
+        try:
+            maysonData = json.loads(content)
+        except ValueError:
+            # the next write brings the next event
+            print(self.filename, "is not valid JSON (yet), waiting for the next write.")
             return
-        else:
-            self.lastModTime = datetime.now()
 
-        print(event.event_type, event.src_path, event.is_directory, self.filename)
-        self.fileChanged.emit()
\ No newline at end of file
+        self.digest = digest
+        print("modified", self.filename)
+        self.fileChanged.emit(maysonData)
@@ -0,0 +1,158 @@
+from OpenGL.GL import *
+from OpenGL.error import GLError
+from os import path, makedirs, replace, remove, scandir, utime
+from collections import OrderedDict
+from hashlib import sha1
+import numpy as np
+
+
+class GLProgramCache:
+
+    # linked programs by hash of their fragment shader source. if the driver can do glGetProgramBinary,
+    # the binaries also go to disk, so the compile is skipped after a restart, too.
+    # needs a current GL context for everything except the constructor.
+    # the source changes with every song length, loop or random, so both are bounded: at most maxPrograms stay linked
+    # (the least recently used one is deleted), and the binaries on disk are dropped least recently used beyond the budget.
+
+    def __init__(self, cachedir = None, maxPrograms = 16, budget = 256 << 20):
+        self.cachedir = path.join(cachedir, 'programs') if cachedir is not None else None
+        self.maxPrograms = maxPrograms
+        self.budget = budget
+        self.programs = OrderedDict()
+        self.binarySupport = None
+        self.driver = None
+
+    def keyOf(self, source):
+        if self.driver is None:
+            # binaries are only valid for the very same driver
+            self.driver = b'|'.join(glGetString(name) or b'' for name in [GL_VENDOR, GL_RENDERER, GL_VERSION])
+        return sha1(self.driver + source.encode()).hexdigest()
+
+    def supportsBinaries(self):
+        if self.binarySupport is None:
+            try:
+                self.binarySupport = bool(glGetProgramBinary) and bool(glProgramBinary) and int(glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS)) > 0
+            except Exception:
+                self.binarySupport = False
+            print("GL program binaries supported:", self.binarySupport)
+        return self.binarySupport
+
+    def program(self, source):
+        # returns (program, None) or (None, error log)
+        key = self.keyOf(source)
+        if key in self.programs:
+            self.programs.move_to_end(key)
+            return self.programs[key], None
+
+        program = self.loadBinary(key)
+        if program is None:
+            program, log = self.compile(source)
+            if program is None:
+                return None, log
+            self.saveBinary(key, program)
+
+        self.programs[key] = program
+        while len(self.programs) > self.maxPrograms:
+            _, evicted = self.programs.popitem(last = False)
+            glDeleteProgram(evicted)
+        return program, None
+
+    def compile(self, source):
+        shader = glCreateShader(GL_FRAGMENT_SHADER)
+        glShaderSource(shader, source)
+        glCompileShader(shader)
+
+        status = glGetShaderiv(shader, GL_COMPILE_STATUS)
+        if status != GL_TRUE:
+            log = glGetShaderInfoLog(shader)
+            glDeleteShader(shader)
+            if not log:
+                return None, 'Error occurred in GL Shader, but info log was empty O.o'
+            return None, log.decode('utf-8')
+
+        program = glCreateProgram()
+        glAttachShader(program, shader)
+        if self.cachedir is not None and self.supportsBinaries():
+            glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+        glLinkProgram(program)
+        glDetachShader(program, shader)
+        glDeleteShader(shader)
+
+        status = glGetProgramiv(program, GL_LINK_STATUS)
+        if status != GL_TRUE:
+            log = glGetProgramInfoLog(program)
+            glDeleteProgram(program)
+            if not log:
+                return None, 'Error occurred in GL Program. but info log was empty O.o'
+            return None, log.decode('utf-8')
+
+        return program, None
+
+    def binaryFileName(self, key):
+        return path.join(self.cachedir, key + '.bin')
+
+    def saveBinary(self, key, program):
+        if self.cachedir is None or not self.supportsBinaries():
+            return
+        size = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+        if size <= 0:
+            return
+        binary = np.empty(size, dtype = np.uint8)
+        length = np.zeros(1, dtype = np.int32)
+        binaryFormat = np.zeros(1, dtype = np.uint32)
+        glGetProgramBinary(program, size, length, binaryFormat, binary)
+        try:
+            makedirs(self.cachedir, exist_ok = True)
+            filename = self.binaryFileName(key)
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(binaryFormat.astype('<u4').tobytes())
+                f.write(binary[:length[0]].tobytes())
+            replace(filename + '.tmp', filename)
+        except OSError as e:
+            print("could not write program binary", key, e)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in scandir(self.cachedir) if entry.name.endswith('.bin'))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= self.budget:
+                break
+            try:
+                remove(filename)
+                total -= size
+            except OSError:
+                continue
+
+    def loadBinary(self, key):
+        if self.cachedir is None or not self.supportsBinaries():
+            return None
+        filename = self.binaryFileName(key)
+        if not path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            data = f.read()
+        binaryFormat = int.from_bytes(data[:4], 'little')
+        binary = np.frombuffer(data, dtype = np.uint8, offset = 4)
+
+        program = glCreateProgram()
+        try:
+            # a format the driver does not list anymore is GL_INVALID_ENUM, which PyOpenGL raises
+            glProgramBinary(program, binaryFormat, binary, binary.size)
+            linked = glGetProgramiv(program, GL_LINK_STATUS) == GL_TRUE
+        except GLError:
+            linked = False
+        if not linked:
+            # driver update or whatever - just compile again
+            print("stale program binary, will recompile", key)
+            glDeleteProgram(program)
+            remove(filename)
+            return None
+        utime(filename)
+        return program
+
+    def release(self):
+        for program in self.programs.values():
+            glDeleteProgram(program)
+        self.programs = OrderedDict()
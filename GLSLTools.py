@@ -0,0 +1,400 @@
+import re
+import struct
+from bisect import bisect_right
+
+# dead code elimination for the generated shaders. this used to be aMaySynBuilder.purgeExpendables(), which ran
+# one regex per function over the whole shader and repeated that until nothing changed anymore.
+# here, the call graph is built in one scan over the identifiers and the dead functions come out in one traversal:
+#  - only functions returning float are candidates (the head has to be "float name(...)" on one line, outside of comments)
+#  - "name(" counts as a use of exactly that name - not of "barname(" or "namebar(" - also in a comment, like before
+#  - a function is dead once its own head is the only use left, which frees everything it calls
+
+definitionPattern = re.compile('(?<!\\w)float +([A-Za-z_]\\w*) *\\([^\\n]*\\)')
+callPattern = re.compile('(?<!\\w)([A-Za-z_]\\w*)[ \\n]*\\(')
+
+def matchingBraces(code):
+    # position of every '{' -> position after its '}'
+    match = {}
+    stack = []
+    for m in re.finditer('[{}]', code):
+        if m.group() == '{':
+            stack.append(m.start())
+        elif stack:
+            match[stack.pop()] = m.end()
+    return match
+
+def functionRanges(masked):
+    # [start, end) of the first definition (with a body, not a prototype) of every candidate, including the newline after its '}'
+    braces = matchingBraces(masked)
+    ranges = {}
+    for m in definitionPattern.finditer(masked):
+        name = m.group(1)
+        if name in ranges:
+            continue
+        # the parameter list ends at the first ')' on the line, the body has to follow right after it
+        open_brace = masked.find(')', m.end(1)) + 1
+        while open_brace < len(masked) and masked[open_brace] in ' \t\n':
+            open_brace += 1
+        if open_brace not in braces:
+            continue
+        end = braces[open_brace]
+        if masked[end:end+1] != '\n':
+            continue
+        ranges[name] = (m.start(), end + 1)
+    return ranges
+
+def callGraph(code, names, ranges):
+    # every use of a candidate name, grouped by the function range it is in (None = outside of all of them)
+    starts = sorted((start, end, name) for name, (start, end) in ranges.items())
+    startPositions = [start for start, _, _ in starts]
+
+    uses = {name: 0 for name in names}
+    calls = {name: [] for name in ranges}
+    calls[None] = []
+    for m in callPattern.finditer(code):
+        callee = m.group(1)
+        if callee not in uses:
+            continue
+        r = bisect_right(startPositions, m.start()) - 1
+        caller = starts[r][2] if r >= 0 and m.start() < starts[r][1] else None
+        uses[callee] += 1
+        calls[caller].append(callee)
+    return uses, calls
+
+def purgeExpendables(code):
+    # returns the purged code and the names of the functions that were removed
+    masked = maskComments(code)
+    names = set(definitionPattern.findall(masked))
+
+    ranges = functionRanges(masked)
+    uses, calls = callGraph(code, names, ranges)
+
+    dead = [name for name in ranges if uses[name] == 1]
+    removed = set()
+    while dead:
+        name = dead.pop()
+        if name in removed:
+            continue
+        removed.add(name)
+        for callee in calls[name]:
+            uses[callee] -= 1
+            if uses[callee] == 1 and callee in ranges and callee not in removed:
+                dead.append(callee)
+
+    parts = []
+    pos = 0
+    for start, end in sorted(ranges[name] for name in removed):
+        parts.append(code[pos:start])
+        pos = end
+    parts.append(code[pos:])
+    purged_code = re.sub('\n[\n]*\n', '\n\n', ''.join(parts))
+
+    return purged_code, sorted(removed)
+
+
+# optional optimisation pass for the driver's sake: constant folding, dead branches, inlining of trivial single-use functions.
+# everything works on a copy of the code where the comments are blanked out, so the positions stay the same and
+# the //MARKERS are never touched. it is conservative - whatever it is not sure about, it leaves alone.
+
+literal = '(?:\\d+\\.\\d*|\\.\\d+|\\d+)(?:[eE][-+]?\\d+)?'
+literalPattern = re.compile(literal)
+foldPattern = re.compile(f'(?<=[(,])\\s*([-+]?\\s*{literal}(?:\\s*[-+*/]\\s*[-+]?\\s*{literal})+)\\s*(?=[,)])')
+tokenPattern = re.compile(f'([-+*/])|({literal})')
+parensPattern = re.compile(f'\\(\\s*(-?{literal})\\s*\\)')
+conditionPattern = re.compile(f'(?<![#\\w])if\\s*\\(\\s*(?:({literal})\\s*(<=|>=|==|!=|<|>)\\s*({literal})|(true|false))\\s*\\)')
+functionPattern = re.compile('^[ \\t]*(float|int|bool|[ib]?vec[234]|mat[234])\\s+(\\w+)\\s*\\(([^()]*)\\)\\s*\\{\\s*return\\s+([^;{}]*);\\s*\\}[ \\t]*\\n?', re.MULTILINE)
+typeName = '(?:float|int|bool|[ib]?vec[234]|mat[234])'
+declarationPattern = re.compile(f'\\b{typeName}\\s+(\\w+)')
+declarationListPattern = re.compile(f'\\b{typeName}\\s+([^;{{}}]*);')
+functionHeadPattern = re.compile('\\b\\w+\\s+\\w+\\s*\\([^()]*\\)\\s*\\{')
+identifierPattern = re.compile('(?<![\\w.])[A-Za-z_]\\w*')
+
+builtins = set('''
+    float int bool void vec2 vec3 vec4 ivec2 ivec3 ivec4 bvec2 bvec3 bvec4 mat2 mat3 mat4 true false
+    radians degrees sin cos tan asin acos atan sinh cosh tanh asinh acosh atanh pow exp log exp2 log2 sqrt inversesqrt
+    abs sign floor trunc round roundEven ceil fract mod modf min max clamp mix step smoothstep isnan isinf
+    length distance dot cross normalize faceforward reflect refract matrixCompMult outerProduct transpose
+    lessThan lessThanEqual greaterThan greaterThanEqual equal notEqual any all not texture texelFetch textureSize
+'''.split())
+
+def maskComments(code):
+    return re.sub('//[^\\n]*|/\\*.*?\\*/', lambda m: re.sub('[^\\n]', ' ', m.group()), code, flags = re.DOTALL)
+
+def applyEdits(code, edits):
+    # edits: (start, end, replacement), the overlapping ones are left for the next pass
+    parts = []
+    pos = 0
+    for start, end, replacement in sorted(edits):
+        if start < pos:
+            continue
+        parts.append(code[pos:start])
+        parts.append(replacement)
+        pos = end
+    parts.append(code[pos:])
+    return ''.join(parts)
+
+def formatFloat(value):
+    # shortest literal that is the same float32 as value
+    single = struct.unpack('f', struct.pack('f', value))[0]
+    for digits in range(1, 10):
+        text = f'{single:.{digits}g}'
+        if struct.unpack('f', struct.pack('f', float(text)))[0] == single:
+            break
+    if '.' not in text and 'e' not in text:
+        text += '.'
+    return text
+
+def literalValue(text):
+    # (value, isFloat) of a GLSL literal, None for octal ints
+    if '.' in text or 'e' in text.lower():
+        return float(text), True
+    if len(text) > 1 and text[0] == '0':
+        return None
+    return int(text), False
+
+def applyOperator(a, op, b):
+    # with the GLSL types: int op int stays int (the division truncates towards zero), anything with a float is float
+    (x, xFloat), (y, yFloat) = a, b
+    isFloat = xFloat or yFloat
+    if op == '+':
+        value = x + y
+    elif op == '-':
+        value = x - y
+    elif op == '*':
+        value = x * y
+    elif isFloat:
+        value = float(x) / float(y)
+    else:
+        value = abs(x) // abs(y) * (1 if (x < 0) == (y < 0) else -1)
+    if not isFloat and not -2**31 <= value < 2**31:
+        raise OverflowError
+    return value, isFloat
+
+def evaluateLiterals(expression):
+    # None if this is nothing to fold safely (octal ints, division by zero, overflow)
+    operands = []
+    operators = []
+    sign = 1
+    for m in tokenPattern.finditer(expression):
+        op, text = m.groups()
+        if text is None:
+            if len(operands) == len(operators):
+                sign *= -1 if op == '-' else 1
+            else:
+                operators.append(op)
+            continue
+        literal = literalValue(text)
+        if literal is None:
+            return None
+        operands.append((sign * literal[0], literal[1]))
+        sign = 1
+    try:
+        # * and / first, left to right, then + and -
+        terms = [operands[0]]
+        additions = []
+        for op, operand in zip(operators, operands[1:]):
+            if op in '*/':
+                terms[-1] = applyOperator(terms[-1], op, operand)
+            else:
+                additions.append(op)
+                terms.append(operand)
+        value = terms[0]
+        for op, term in zip(additions, terms[1:]):
+            value = applyOperator(value, op, term)
+    except (ArithmeticError, IndexError):
+        return None
+    value, isFloat = value
+    if not isFloat:
+        return str(value)
+    try:
+        return formatFloat(float(value)) if abs(value) < 3.4e38 else None
+    except (OverflowError, struct.error):
+        return None
+
+def previousChar(code, pos):
+    pos -= 1
+    while pos >= 0 and code[pos] in ' \t\n':
+        pos -= 1
+    return code[pos] if pos >= 0 else ''
+
+def foldConstants(code, masked):
+    edits = []
+    for m in foldPattern.finditer(masked):
+        value = evaluateLiterals(m.group(1))
+        if value is not None:
+            edits.append((m.start(1), m.end(1), value))
+    # (3.) -> 3. where the parentheses are no call / cast and the sign can not stick to an operator
+    for m in parensPattern.finditer(masked):
+        before = previousChar(masked, m.start())
+        if before and (before.isalnum() or before in '_)]'):
+            continue
+        if m.group(1).startswith('-') and before not in '(,=':
+            continue
+        edits.append((m.start(), m.end(), m.group(1)))
+    return edits
+
+def statementEnd(masked, pos):
+    # end of the statement starting at pos: a {block} or up to the next ';' - None if that is not simple
+    while pos < len(masked) and masked[pos] in ' \t\n':
+        pos += 1
+    if masked.startswith('{', pos):
+        depth = 0
+        for i in range(pos, len(masked)):
+            depth += {'{': 1, '}': -1}.get(masked[i], 0)
+            if depth == 0:
+                return pos, i + 1
+        return None
+    if re.match('(if|for|while|do|switch|else)\\b', masked[pos:pos+7]):
+        return None
+    depth = 0
+    for i in range(pos, len(masked)):
+        c = masked[i]
+        if c in '({[':
+            depth += 1
+        elif c in ')}]':
+            depth -= 1
+            if depth < 0:
+                return None
+        elif c == ';' and depth == 0:
+            return pos, i + 1
+    return None
+
+def removeDeadBranches(code, masked):
+    edits = []
+    for m in conditionPattern.finditer(masked):
+        if m.group(4):
+            condition = m.group(4) == 'true'
+        else:
+            left, op, right = float(m.group(1)), m.group(2), float(m.group(3))
+            condition = {'<': left < right, '>': left > right, '<=': left <= right, '>=': left >= right, '==': left == right, '!=': left != right}[op]
+
+        then_range = statementEnd(masked, m.end())
+        if then_range is None:
+            continue
+        end = then_range[1]
+        else_range = None
+        else_match = re.match('\\s*else\\b', masked[end:end+64])
+        if else_match:
+            else_range = statementEnd(masked, end + else_match.end())
+            if else_range is None:
+                continue
+            end = else_range[1]
+
+        kept = then_range if condition else else_range
+        # an empty block instead of nothing, in case this was the body of another if / else
+        edits.append((m.start(), end, code[kept[0]:kept[1]] if kept else '{}'))
+    return edits
+
+def localNames(masked, start, end):
+    # everything declared in masked[start:end] (parameters, locals, loop variables), also "float a = 1., b;"
+    text = masked[start:end]
+    names = set(declarationPattern.findall(text))
+    for declaration in declarationListPattern.findall(text):
+        while re.search('\\([^()]*\\)|\\[[^\\[\\]]*\\]', declaration):
+            declaration = re.sub('\\([^()]*\\)|\\[[^\\[\\]]*\\]', '', declaration)
+        names.update(re.findall('(?:^|,)\\s*(\\w+)', declaration))
+    return names
+
+def inlineFunctions(code, masked):
+    globalNames = set(builtins)
+    globalNames.update(re.findall('\\b(?:const|uniform)\\s+\\w+\\s+(\\w+)', masked))
+    globalNames.update(re.findall('#define\\s+(\\w+)', masked))
+    globalNames.update(re.findall('\\b\\w+\\s+(\\w+)\\s*\\([^()]*\\)\\s*\\{', masked))
+
+    # the functions the calls are in, for their local names
+    braces = matchingBraces(masked)
+    functions = [(m.start(), braces[m.end() - 1]) for m in functionHeadPattern.finditer(masked) if m.end() - 1 in braces]
+
+    uses = {}
+    for m in identifierPattern.finditer(masked):
+        uses.setdefault(m.group(), []).append(m.start())
+
+    edits = []
+    for f in functionPattern.finditer(masked):
+        returnType, name, paramList, expression = f.groups()
+        if len(uses.get(name, [])) != 2 or name in builtins:
+            continue
+        call = [pos for pos in uses[name] if not f.start() <= pos < f.end()]
+        if len(call) != 1 or not re.match(re.escape(name) + '\\s*\\(', masked[call[0]:]):
+            continue
+
+        params = []
+        if paramList.strip() not in ['', 'void']:
+            for param in paramList.split(','):
+                parts = param.split()
+                if parts and parts[0] in ['const', 'in']:
+                    parts = parts[1:]
+                if len(parts) != 2 or not re.fullmatch('\\w+', parts[1]):
+                    params = None
+                    break
+                params.append((parts[0], parts[1]))
+        if params is None:
+            continue
+        paramNames = [p for _, p in params]
+        names = set(identifierPattern.findall(expression)) - set(paramNames)
+        if any(n not in globalNames for n in names):
+            continue
+        # a global that the calling function hides behind a local of the same name would bind to that local
+        caller = next(((start, end) for start, end in functions if start <= call[0] < end), None)
+        if caller is not None and names & localNames(masked, *caller):
+            continue
+
+        # the arguments of the one call
+        open_paren = masked.index('(', call[0])
+        depth = 0
+        args = []
+        start = open_paren + 1
+        for i in range(open_paren, len(masked)):
+            c = masked[i]
+            if c in '([{':
+                depth += 1
+            elif c in ')]}':
+                depth -= 1
+                if depth == 0:
+                    args.append(code[start:i])
+                    close_paren = i + 1
+                    break
+            elif c == ',' and depth == 1:
+                args.append(code[start:i])
+                start = i + 1
+        else:
+            continue
+        if args == [''] and not params:
+            args = []
+        if len(args) != len(params) or any('//' in arg or '/*' in arg for arg in args):
+            continue
+
+        # T(arg) keeps the implicit conversions of the call. an argument that is used more than once has to be simple
+        substitutions = {}
+        for (paramType, paramName), arg in zip(params, args):
+            count = len(re.findall('(?<![\\w.])' + paramName + '\\b', expression))
+            if count > 1 and not re.fullmatch('\\s*[\\w.]+\\s*', arg):
+                break
+            substitutions[paramName] = f'{paramType}({arg.strip()})'
+        else:
+            # the call and the definition go together, or not at all (this pass)
+            spans = [(call[0], close_paren), (f.start(), f.end())]
+            if any(start < taken_end and taken_start < end for start, end in spans for taken_start, taken_end, _ in edits):
+                continue
+            body = identifierPattern.sub(lambda m: substitutions.get(m.group(), m.group()), expression)
+            edits.append((call[0], close_paren, f'{returnType}({body.strip()})'))
+            edits.append((f.start(), f.end(), ''))
+    return edits
+
+def optimize(code, passes = 8):
+    # returns the optimized code and how much of what was done
+    stats = {'folded': 0, 'branches': 0, 'inlined': 0}
+    for _ in range(passes):
+        changed = False
+        for key, step in [('folded', foldConstants), ('branches', removeDeadBranches), ('inlined', inlineFunctions)]:
+            edits = step(code, maskComments(code))
+            if edits:
+                newCode = applyEdits(code, edits)
+                if newCode != code:
+                    stats[key] += len(edits) if key != 'inlined' else len(edits) // 2
+                    code = newCode
+                    changed = True
+        if not changed:
+            break
+    code = re.sub('\n[\n]*\n', '\n\n', code)
+    return code, stats
@@ -0,0 +1,77 @@
+from PyQt5.QtCore import QIODevice, pyqtSignal, pyqtSlot
+
+
+class ProgressiveAudioBuffer(QIODevice):
+
+    # read-only audio device over a buffer that is still being rendered into.
+    # only the first `available` bytes are handed out, QAudioOutput just pulls whatever is there already.
+    # follow() a renderer to get its blocks: blockRendered arrives in this device's thread (queued, if the renderer lives in another one),
+    # so the read position and `available` are only ever touched from here.
+
+    firstBlockReady = pyqtSignal()
+
+    def __init__(self, parent = None):
+        super().__init__(parent)
+        self.data = None
+        self.available = 0
+        self.readpos = 0
+        self.finished = False
+        self.renderer = None
+
+    def follow(self, renderer):
+        self.renderer = renderer
+        renderer.blockRendered.connect(self.renderedBlock)
+
+    def unfollow(self):
+        if self.renderer is not None:
+            self.renderer.blockRendered.disconnect(self.renderedBlock)
+            self.renderer = None
+        self.finish()
+
+    @pyqtSlot(int)
+    def renderedBlock(self, block):
+        if self.renderer is None:
+            return
+        if self.data is None:
+            self.setData(self.renderer.floatmusic)
+        self.setAvailable((block + 1) * self.renderer.blocksize * 2 * self.renderer.floatmusic.itemsize)
+
+    def setData(self, data):
+        self.data = memoryview(data).cast('B')
+        self.available = 0
+        self.readpos = 0
+        self.finished = False
+
+    def setAvailable(self, nbytes):
+        if self.data is None:
+            return
+        wasEmpty = self.available == 0
+        self.available = min(nbytes, len(self.data))
+        if wasEmpty and self.available > 0:
+            self.firstBlockReady.emit()
+        self.readyRead.emit()
+
+    def finish(self):
+        if self.data is not None:
+            self.setAvailable(len(self.data))
+        self.finished = True
+
+    def isSequential(self):
+        return True
+
+    def bytesAvailable(self):
+        return self.available - self.readpos + super().bytesAvailable()
+
+    def atEnd(self):
+        return self.finished and self.readpos >= self.available
+
+    def readData(self, maxlen):
+        n = min(maxlen, self.available - self.readpos)
+        if n <= 0:
+            return bytes()
+        chunk = self.data[self.readpos : self.readpos + n].tobytes()
+        self.readpos += n
+        return chunk
+
+    def writeData(self, data):
+        return -1
@@ -0,0 +1,126 @@
+from os import path, makedirs, replace, remove, scandir, utime
+from hashlib import sha1
+import numpy as np
+
+
+class RenderCache:
+
+    # rendered float samples by hash of everything that goes into the render (shader, sequence, samplerate, texsize, length).
+    # the files are plain little endian float32, the least recently used ones go when the budget is exceeded.
+
+    def __init__(self, cachedir = None, budget = 2 << 30):
+        self.cachedir = path.join(cachedir, 'renders') if cachedir is not None else None
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        return self.cachedir is not None and self.budget > 0
+
+    def keyOf(self, shader, sequence, samplerate, texsize, song_length, floatOutput = False):
+        digest = sha1(shader.encode())
+        digest.update(bytes(sequence) if sequence is not None else b'')
+        digest.update(repr((samplerate, texsize, song_length, floatOutput)).encode())
+        return digest.hexdigest()
+
+    def fileName(self, key):
+        return path.join(self.cachedir, key + '.f32')
+
+    def load(self, key):
+        # memory mapped, so a hit costs nothing until somebody actually reads the samples
+        if not self.enabled() or not path.exists(self.fileName(key)):
+            self.misses += 1
+            return None
+        try:
+            floatmusic = np.memmap(self.fileName(key), dtype = '<f4', mode = 'r')
+            utime(self.fileName(key))
+        except (OSError, ValueError) as e:
+            print("could not read render cache entry", key, e)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return floatmusic
+
+    def store(self, key, floatmusic):
+        if not self.enabled() or floatmusic is None:
+            return
+        if floatmusic.nbytes > self.budget:
+            print("render is larger than the whole render cache, not stored.")
+            return
+        try:
+            makedirs(self.cachedir, exist_ok = True)
+            filename = self.fileName(key)
+            floatmusic.astype('<f4', copy = False).tofile(filename + '.tmp')
+            replace(filename + '.tmp', filename)
+        except OSError as e:
+            print("could not write render cache entry", key, e)
+            return
+        self.evict()
+
+    def streamed(self, key, nbytes):
+        # for renders that are never in memory as a whole (headless WAV export): the blocks are written as they come,
+        # commit() turns them into an entry. None if the render should not be cached
+        if not self.enabled():
+            return None
+        if nbytes > self.budget:
+            print("render is larger than the whole render cache, not stored.")
+            return None
+        try:
+            makedirs(self.cachedir, exist_ok = True)
+            return StreamedEntry(self, key, open(self.fileName(key) + '.tmp', 'wb'))
+        except OSError as e:
+            print("could not write render cache entry", key, e)
+            return None
+
+    def evict(self):
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in scandir(self.cachedir) if entry.name.endswith('.f32'))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= self.budget:
+                break
+            try:
+                remove(filename)
+                total -= size
+            except OSError:
+                # e.g. still mapped somewhere on windows, try again next time
+                continue
+
+
+class StreamedEntry:
+
+    def __init__(self, cache, key, file):
+        self.cache = cache
+        self.key = key
+        self.file = file
+
+    def write(self, floatmusic):
+        if self.file is None:
+            return
+        try:
+            np.asarray(floatmusic, dtype = np.float32).astype('<f4', copy = False).tofile(self.file)
+        except OSError as e:
+            print("could not write render cache entry", self.key, e)
+            self.discard()
+
+    def commit(self):
+        if self.file is None:
+            return
+        filename = self.cache.fileName(self.key)
+        try:
+            self.file.close()
+            self.file = None
+            replace(filename + '.tmp', filename)
+        except OSError as e:
+            print("could not write render cache entry", self.key, e)
+            self.discard()
+            return
+        self.cache.evict()
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        try:
+            remove(self.cache.fileName(self.key) + '.tmp')
+        except OSError:
+            pass
@@ -23,25 +23,67 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from PyQt5.QtWidgets import QOpenGLWidget
-from PyQt5.QtWidgets import *
+from PyQt5.QtGui import QOpenGLContext, QOffscreenSurface, QSurfaceFormat
 from PyQt5.QtCore import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
-from math import ceil, floor, sqrt
-from struct import pack, unpack
+from math import ceil
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import time
 import numpy as np
 
+from GLProgramCache import GLProgramCache
 
-class SFXGLWidget(QOpenGLWidget):
 
-    def __init__(self, parent, samplerate, duration, texsize, moreUniforms = {}):
-        QOpenGLWidget.__init__(self, parent)
-        self.move(10000.,1000.)
+class SFXGLWidget(QObject):
+
+    blockRendered = pyqtSignal(int)
+    stripRendered = pyqtSignal()
+
+    # values per row of the sequence texture, rfloat() in aMaySynBuilder.sequenceTextureHeader() knows this as SEQ_WIDTH
+    sequenceWidth = 2048
+
+    # this used to be a (hidden) QOpenGLWidget that was created for every render. now it is one long-lived
+    # offscreen renderer that owns its context, the framebuffer, both textures and the compiled programs.
+    # the name stayed, because everybody knows it by now.
+
+    def __init__(self, parent = None, samplerate = 44100, duration = 0, texsize = 512, moreUniforms = {}, cachedir = None):
+        QObject.__init__(self, parent)
         self.program = 0
         self.iSampleRateLocation = 0
         self.iBlockOffsetLocation = 0
-        self.hasShader = False
+        self.context = None
+        self.surface = None
+        self.framebuffer = None
+        self.texture = None
+        self.texture_size = None
+        self.texture_float = None
+        self.music = None
+        self.floatmusic = None
+        self.sequence_texture_handle = None
+        self.sequence_texture_handle_size = None
+        self.sequence_texture = None
+        self.sequence_texture_size = None
+        self.sequence_texture_dirty = False
+        self.usePixelBuffers = True
+        self.pixel_buffer_support = None
+        self.pixel_buffers = None
+        self.pixel_buffer_size = None
+        self.readback = None
+        self.converter = ThreadPoolExecutor(max_workers = 1)
+        self.programCache = GLProgramCache(cachedir)
+        self.floatOutput = False
+        self.keepMusic = True
+        # > 0: every block is drawn in strips of this many rows, with a glFinish() and stripRendered after each one
+        self.stripRows = 0
+        self.configure(samplerate, duration, texsize, moreUniforms)
+
+    def configure(self, samplerate, duration, texsize, moreUniforms = None, floatOutput = False, keepMusic = True):
+        # floatOutput: the shader writes vec4(left, right, 0, 1) into a GL_RG32F target instead of packed 16bit RGBA8
+        # keepMusic = False: floatmusic is only a ring of two blocks, whoever listens to blockRendered has to take them away in time
+        self.floatOutput = floatOutput
+        self.keepMusic = keepMusic
         self.duration = duration
         self.samplerate = samplerate
         self.texsize = texsize
@@ -50,19 +92,32 @@ class SFXGLWidget(QOpenGLWidget):
         self.nblocks = int(ceil(float(self.nsamples)/float(self.blocksize)))
         self.nsamples_real = self.nblocks*self.blocksize # this too was *2
         self.duration_real = float(self.nsamples_real)/float(self.samplerate)
-        self.music = None
-        self.floatmusic = None
-        self.moreUniforms = moreUniforms
-        self.sequence_texture_handle = None
-        self.sequence_texture = None
-        self.sequence_texture_size = None
-        self.setTextureFormat(GL_RGBA)
+        if moreUniforms is not None:
+            self.moreUniforms = moreUniforms
+
+    def makeCurrent(self):
+        if self.context is None:
+            self.initializeGL()
+        elif not self.context.makeCurrent(self.surface):
+            raise RuntimeError("could not make the SFX GL context current")
+
+    def doneCurrent(self):
+        if self.context is not None:
+            self.context.doneCurrent()
 
     def initializeGL(self):
         print("Init.")
 
-        if self.sequence_texture is not None:
-            self.initSequenceTexture()
+        self.surface = QOffscreenSurface()
+        self.surface.setFormat(QSurfaceFormat.defaultFormat())
+        self.surface.create()
+
+        self.context = QOpenGLContext(self)
+        self.context.setFormat(QSurfaceFormat.defaultFormat())
+        if not self.context.create() or not self.context.makeCurrent(self.surface):
+            self.context = None
+            raise RuntimeError("could not create an offscreen GL context for the SFX")
+        self.context.aboutToBeDestroyed.connect(self.releaseGL)
 
         self.framebuffer = glGenFramebuffers(1)
         glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
@@ -70,59 +125,265 @@ class SFXGLWidget(QOpenGLWidget):
         glPixelStorei(GL_PACK_ALIGNMENT, 4)
         glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
 
+    def initRenderTarget(self):
+        # only reallocate if the texsize (or the format) actually changed
+        if self.texture is not None and self.texture_size == self.texsize and self.texture_float == self.floatOutput:
+            return
+        if self.texture is not None:
+            glDeleteTextures([self.texture])
+
         self.texture = glGenTextures(1)
+        self.texture_size = self.texsize
+        self.texture_float = self.floatOutput
         glBindTexture(GL_TEXTURE_2D, self.texture)
-        print("Bound texture with id", self.texture)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.texsize, self.texsize, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+        print("Bound texture with id", self.texture, "(float)" if self.floatOutput else "")
+        if self.floatOutput:
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RG32F, self.texsize, self.texsize, 0, GL_RG, GL_FLOAT, None)
+        else:
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.texsize, self.texsize, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
         print("Teximage2D returned.")
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
 
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
         glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.texture, 0)
 
 
     def setTextureFromSequence(self, sequence):
-        #self.sequence_texture = np.array(sequence, dtype = np.uint32)
+        # sequence: float16 (GL_R16F) or float32 (GL_R32F) values, one per texel, in rows of sequenceWidth (the shader uses texelFetch)
+        if sequence is not None and not isinstance(sequence, np.ndarray):
+            sequence = np.frombuffer(bytes(sequence), dtype = '=f2')
         self.sequence_texture = sequence
-        self.sequence_texture_size = ceil(sqrt(len(sequence)))
+        if sequence is None:
+            self.sequence_texture_size = None
+        else:
+            width = max(1, min(len(sequence), self.sequenceWidth))
+            self.sequence_texture_size = (width, -(-len(sequence) // width), sequence.dtype.itemsize)
+        self.sequence_texture_dirty = True
 
     def initSequenceTexture(self):
-        self.sequence_texture_handle = glGenTextures(1)
+        if not self.sequence_texture_dirty:
+            return
+        self.sequence_texture_dirty = False
+
+        if self.sequence_texture_handle is None:
+            self.sequence_texture_handle = glGenTextures(1)
         glBindTexture(GL_TEXTURE_2D, self.sequence_texture_handle)
         print("Bound texture with id", self.sequence_texture_handle, "(for sequence)")
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.sequence_texture_size, self.sequence_texture_size, 0, GL_RGBA, GL_UNSIGNED_BYTE, self.sequence_texture)
+        width, height, itemsize = self.sequence_texture_size
+        internalFormat, dataType = (GL_R16F, GL_HALF_FLOAT) if itemsize == 2 else (GL_R32F, GL_FLOAT)
+        # padded only up to the end of the last row
+        data = np.zeros(width * height, dtype = self.sequence_texture.dtype)
+        data[:len(self.sequence_texture)] = self.sequence_texture
+        # rows of half floats need not be 4 byte aligned. back to 4 afterwards, like initializeGL() set it up
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        if self.sequence_texture_handle_size == self.sequence_texture_size:
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, width, height, GL_RED, dataType, data)
+        else:
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+            glTexImage2D(GL_TEXTURE_2D, 0, internalFormat, width, height, 0, GL_RED, dataType, data)
+            self.sequence_texture_handle_size = self.sequence_texture_size
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
 
+    def measureCompileTime(self, source):
+        # seconds for compiling + linking, without the program cache. None if it does not compile at all
+        self.makeCurrent()
+        starttime = time.perf_counter()
+        program, log = self.programCache.compile(source)
+        seconds = time.perf_counter() - starttime
+        if program is None:
+            print(log)
+        else:
+            glDeleteProgram(program)
+        self.doneCurrent()
+        return seconds if program is not None else None
+
+    def releaseGL(self):
+        if self.context is None:
+            return
+        self.context.makeCurrent(self.surface)
+        self.programCache.release()
+        if self.texture is not None:
+            glDeleteTextures([self.texture])
+        if self.sequence_texture_handle is not None:
+            glDeleteTextures([self.sequence_texture_handle])
+        if self.framebuffer is not None:
+            glDeleteFramebuffers(1, [self.framebuffer])
+        if self.pixel_buffers is not None:
+            glDeleteBuffers(len(self.pixel_buffers), self.pixel_buffers)
+        self.pixel_buffers = None
+        self.pixel_buffer_size = None
+        self.texture = None
+        self.texture_size = None
+        self.sequence_texture_handle = None
+        self.sequence_texture_handle_size = None
+        self.sequence_texture_dirty = self.sequence_texture is not None
+        self.framebuffer = None
+        self.context.doneCurrent()
+
+    def destroy(self):
+        self.releaseGL()
+        self.converter.shutdown()
+        if self.context is not None:
+            self.context.aboutToBeDestroyed.disconnect(self.releaseGL)
+            self.context.deleteLater()
+            self.context = None
+        if self.surface is not None:
+            self.surface.destroy()
+            self.surface = None
+
+
+    def supportsPixelBuffers(self):
+        if self.pixel_buffer_support is None:
+            try:
+                self.pixel_buffer_support = bool(glGenBuffers) and bool(glMapBufferRange) and bool(glFenceSync) and bool(glClientWaitSync)
+            except Exception:
+                self.pixel_buffer_support = False
+            print("pipelined PBO readback supported:", self.pixel_buffer_support)
+        return self.pixel_buffer_support
+
+    def readFormat(self):
+        # (format, type, bytes per texel) of the render target
+        return (GL_RG, GL_FLOAT, 8) if self.floatOutput else (GL_RGBA, GL_UNSIGNED_BYTE, 4)
+
+    def initPixelBuffers(self):
+        size = self.blocksize * self.readFormat()[2]
+        if self.pixel_buffers is not None and self.pixel_buffer_size == size:
+            return
+        if self.pixel_buffers is not None:
+            glDeleteBuffers(len(self.pixel_buffers), self.pixel_buffers)
+        self.pixel_buffers = list(glGenBuffers(2))
+        self.pixel_buffer_size = size
+        for pbo in self.pixel_buffers:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            glBufferData(GL_PIXEL_PACK_BUFFER, size, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+    def drawBlock(self, i):
+        glUniform1f(self.iBlockOffsetLocation, np.float32(i*self.blocksize))
+
+        if self.stripRows <= 0 or self.stripRows >= self.texsize:
+            self.drawQuad()
+            return
+
+        # one block can take seconds on a slow renderer. in strips, whoever listens to stripRendered gets a word in between
+        glEnable(GL_SCISSOR_TEST)
+        for row in range(0, self.texsize, self.stripRows):
+            glScissor(0, row, self.texsize, min(self.stripRows, self.texsize - row))
+            self.drawQuad()
+            glFinish()
+            self.stripRendered.emit()
+        glDisable(GL_SCISSOR_TEST)
+
+    def drawQuad(self):
+        glBegin(GL_QUADS)
+        glVertex2f(-1,-1)
+        glVertex2f(-1,1)
+        glVertex2f(1,1)
+        glVertex2f(1,-1)
+        glEnd()
+
+    def musicBlock(self, i):
+        if not self.keepMusic:
+            # block i+2 is only converted after block i was emitted, so two slots are enough
+            i %= 2
+        return self.floatmusic[2*i*self.blocksize:2*(i+1)*self.blocksize]
+
+    def convertBlock(self, i, raw):
+        # runs on the conversion thread, numpy lets go of the GIL for this. converts in place, no temporaries
+        target = self.musicBlock(i)
+        if self.floatOutput:
+            np.copyto(target, np.frombuffer(raw, dtype = '<f4'))
+            return
+        np.subtract(np.frombuffer(raw, dtype = '<u2'), np.float32(32768.), out = target, dtype = np.float32)
+        np.divide(target, np.float32(32768.), out = target)
+
+    def renderBlocks(self, blocks):
+        readFormat, readType, _ = self.readFormat()
+        if not self.floatOutput and (self.readback is None or self.readback.size != 2*self.blocksize):
+            self.readback = np.empty(2*self.blocksize, dtype = '<u2')
+        for i in blocks:
+            self.drawBlock(i)
+            glFlush()
+            # float samples go straight into their place in floatmusic, the 16bit ones through one reused scratch block
+            target = self.musicBlock(i) if self.floatOutput else self.readback
+            glReadPixels(0, 0, self.texsize, self.texsize, readFormat, readType, target if self.floatOutput else target.view(np.uint8))
+            if not self.floatOutput:
+                self.convertBlock(i, target)
+            self.blockRendered.emit(i)
+
+    def renderBlocksPipelined(self, blocks):
+        # ping-pong between two PBOs: while block i renders into one of them, block i-1 is mapped from the other
+        # and converted on the converter thread. the slot is only unmapped again right before it is needed for i+1.
+        self.initPixelBuffers()
+        readFormat, readType, _ = self.readFormat()
+        slots = [None, None]
+
+        for n, i in enumerate(blocks):
+            slot = n % 2
+            self.finishPixelBuffer(slots, slot)
+
+            self.drawBlock(i)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pixel_buffers[slot])
+            glReadPixels(0, 0, self.texsize, self.texsize, readFormat, readType, ctypes.c_void_p(0))
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+            slots[slot] = (i, glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0), None)
+            glFlush()
 
-    def computeShader(self, source) :
+            if n > 0:
+                self.mapPixelBuffer(slots, 1 - slot)
+
+        for n in range(max(0, len(blocks) - 2), len(blocks)):
+            self.finishPixelBuffer(slots, n % 2)
+
+    def mapPixelBuffer(self, slots, slot):
+        block, fence, _ = slots[slot]
+        while glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 1000000000) == GL_TIMEOUT_EXPIRED:
+            pass
+        glDeleteSync(fence)
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pixel_buffers[slot])
+        pointer = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.pixel_buffer_size, GL_MAP_READ_BIT)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        address = pointer if isinstance(pointer, int) else ctypes.cast(pointer, ctypes.c_void_p).value
+        raw = (ctypes.c_ubyte * self.pixel_buffer_size).from_address(address)
+
+        slots[slot] = (block, None, self.converter.submit(self.convertBlock, block, raw))
+
+    def finishPixelBuffer(self, slots, slot):
+        if slots[slot] is None:
+            return
+        if slots[slot][2] is None:
+            self.mapPixelBuffer(slots, slot)
+        block, _, conversion = slots[slot]
+        conversion.result()
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pixel_buffers[slot])
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        slots[slot] = None
+        self.blockRendered.emit(block)
+
+    def computeShader(self, source, blocks = None, base = None) :
+        # blocks / base: only render these blocks, into a copy of base (a former render of the same length)
         useSequenceTexture = (self.sequence_texture is not None)
+        self.music = None
+        self.floatmusic = None
 
-        self.shader = glCreateShader(GL_FRAGMENT_SHADER)
-        glShaderSource(self.shader, source)
-        glCompileShader(self.shader)
-
-        status = glGetShaderiv(self.shader, GL_COMPILE_STATUS)
-        if status != GL_TRUE :
-            log = glGetShaderInfoLog(self.shader)
-            if not log:
-                return 'Error occurred in GL Shader, but info log was empty O.o'
-            return log.decode('utf-8')
-
-        self.program = glCreateProgram()
-        glAttachShader(self.program, self.shader)
-        glLinkProgram(self.program)
+        self.makeCurrent()
+        self.initRenderTarget()
+        if useSequenceTexture:
+            self.initSequenceTexture()
 
-        status = glGetProgramiv(self.program, GL_LINK_STATUS)
-        if status != GL_TRUE :
-            log = glGetProgramInfoLog(self.program)
-            if not log:
-                return 'Error occurred in GL Program. but info log was empty O.o'
-            return log.decode('utf-8')
+        self.program, log = self.programCache.program(source)
+        if self.program is None:
+            self.doneCurrent()
+            return log
 
         glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
         glUseProgram(self.program)
@@ -132,7 +393,6 @@ class SFXGLWidget(QOpenGLWidget):
         self.iSampleRateLocation = glGetUniformLocation(self.program, 'iSampleRate')
         if useSequenceTexture:
             self.sfx_sequence_texture_location = glGetUniformLocation(self.program, 'iSequence');
-            self.sfx_sequence_texture_width_location = glGetUniformLocation(self.program, 'iSequenceWidth');
 
 
         self.uniformLocation = {}
@@ -141,7 +401,12 @@ class SFXGLWidget(QOpenGLWidget):
             glUniform1f(self.uniformLocation[uniform], np.float32(self.moreUniforms[uniform]))
 
         OpenGL.UNSIGNED_BYTE_IMAGES_AS_STRING = True
-        music = bytearray(self.nblocks*self.blocksize*4)
+        # stereo float samples, filled block by block - listeners of blockRendered may already read the finished part
+        if blocks is not None and base is not None and self.keepMusic and len(base) == self.nblocks*self.blocksize*2:
+            self.floatmusic = np.array(base, dtype = np.float32)
+        else:
+            self.floatmusic = np.empty((self.nblocks if self.keepMusic else min(2, self.nblocks))*self.blocksize*2, dtype = np.float32)
+            blocks = range(self.nblocks)
 
         glViewport(0, 0, self.texsize, self.texsize)
 
@@ -149,33 +414,22 @@ class SFXGLWidget(QOpenGLWidget):
         glUniform1f(self.iSampleRateLocation, np.float32(self.samplerate))
         if useSequenceTexture:
             glUniform1i(self.sfx_sequence_texture_location, 0)
-            glUniform1f(self.sfx_sequence_texture_width_location, np.float32(self.sequence_texture_size))
             glActiveTexture(GL_TEXTURE0)
             print("handle", self.sequence_texture_handle)
             glBindTexture(GL_TEXTURE_2D, self.sequence_texture_handle)
 
-        for i in range(self.nblocks) :
-            glUniform1f(self.iBlockOffsetLocation, np.float32(i*self.blocksize))
-
-            glBegin(GL_QUADS)
-            glVertex2f(-1,-1)
-            glVertex2f(-1,1)
-            glVertex2f(1,1)
-            glVertex2f(1,-1)
-            glEnd()
-
-            glFlush()
-
-            music[4*i*self.blocksize:4*(i+1)*self.blocksize] = glReadPixels(0, 0, self.texsize, self.texsize, GL_RGBA, GL_UNSIGNED_BYTE)
-
-        music = unpack('<'+str(self.blocksize*self.nblocks*2)+'H', music)
-        music = (np.float32(music)-32768.)/32768.
-        self.floatmusic = music
+        if self.usePixelBuffers and self.supportsPixelBuffers():
+            self.renderBlocksPipelined(blocks)
+        else:
+            self.renderBlocks(blocks)
 
-        music = pack('<'+str(self.blocksize*self.nblocks*2)+'f', *music)
-        self.music = music
+        if self.keepMusic:
+            # same memory as floatmusic, just the raw bytes view (for playback / QAudioFormat Float, LittleEndian)
+            self.music = memoryview(self.floatmusic.astype('<f4', copy = False)).cast('B')
+        else:
+            self.floatmusic = None
 
-        #glBindFramebuffer(GL_FRAMEBUFFER, 0)
-        #glDeleteTextures([self.texture])
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        self.doneCurrent()
 
         return 'Success.'
@@ -0,0 +1,62 @@
+from os import stat
+from hashlib import sha1
+import re
+
+
+class ShaderTemplate:
+
+    # a template, split once into literal chunks and placeholder slots - so filling it in is one ''.join().
+    # the result is the same as template.replace(p1, v1).replace(p2, v2)... in the order of the placeholders,
+    # i.e. a value may contain the placeholders that come after its own (these get filled in, too), but not the ones before.
+
+    def __init__(self, text, placeholders):
+        self.text = text
+        self.digest = sha1(text.encode()).hexdigest()
+        self.placeholders = list(placeholders)
+        self.plan = []
+
+        if not self.placeholders:
+            self.plan.append(text)
+            return
+        pattern = re.compile('|'.join(re.escape(p) for p in self.placeholders))
+        pos = 0
+        for m in pattern.finditer(text):
+            self.plan.append(text[pos:m.start()])
+            self.plan.append(self.placeholders.index(m.group()))
+            pos = m.end()
+        self.plan.append(text[pos:])
+
+    def __repr__(self):
+        return f"ShaderTemplate({len(self.text)} chars, {sum(isinstance(p, int) for p in self.plan)} slots)"
+
+    def substitute(self, values):
+        # values: {placeholder: value}, the missing ones stay as they are
+        filled = []
+        for i, placeholder in enumerate(self.placeholders):
+            value = values.get(placeholder, placeholder)
+            for later in self.placeholders[i+1:]:
+                if later in value:
+                    value = value.replace(later, values.get(later, later))
+            filled.append(value)
+        return ''.join(filled[part] if isinstance(part, int) else part for part in self.plan)
+
+
+class TemplateCache:
+
+    # the template files, read again only when their mtime / size changes
+
+    def __init__(self):
+        self.templates = {}
+
+    def get(self, filename, placeholders = ()):
+        info = stat(filename)
+        signature = (info.st_mtime_ns, info.st_size, tuple(placeholders))
+        cached = self.templates.get(filename)
+        if cached is None or cached[0] != signature:
+            with open(filename) as f:
+                cached = (signature, ShaderTemplate(f.read(), placeholders))
+            self.templates[filename] = cached
+        return cached[1]
+
+    def text(self, filename):
+        return self.get(filename).text
@@ -0,0 +1,58 @@
+from hashlib import sha1
+import json
+import numpy as np
+
+
+class StemMixer:
+
+    # keeps the per-track stems of the last song render, all rendered with par_norm = level_syn = level_drum = 1.
+    # these are plain gains, so changing them (or muting) is just a weighted sum of the stems, no GPU involved.
+    # the weighted sums of the synth and drum tracks are kept as two buses, so level_syn / level_drum alone is even cheaper.
+
+    # everything in a track / the info that the remix can take care of
+    gainKeys = ['par_norm', 'mute']
+    levelKeys = ['level_syn', 'level_drum']
+
+    def __init__(self):
+        self.key = None
+        self.stems = None
+        self.isDrum = None
+        self.busGains = None
+        self.buses = None
+
+    def keyOf(self, tracks, patterns, info, *more):
+        # everything that goes into the stems, without the gains
+        tracks = [{k: v for k, v in t.items() if k not in self.gainKeys} for t in tracks]
+        info = {k: v for k, v in info.items() if k not in self.levelKeys}
+        payload = json.dumps([tracks, patterns, info, repr(more)], sort_keys = True, default = repr)
+        return sha1(payload.encode()).hexdigest()
+
+    def matches(self, key):
+        return self.key is not None and self.key == key
+
+    def setStems(self, key, stems, isDrum):
+        # stems: one array per track (None for silent ones), all with the same length
+        length = max((len(stem) for stem in stems if stem is not None), default = 0)
+        self.stems = np.zeros((len(stems), length), dtype = np.float32)
+        for t, stem in enumerate(stems):
+            if stem is not None:
+                self.stems[t, :len(stem)] = stem
+        self.isDrum = np.asarray(isDrum, dtype = bool)
+        self.key = key
+        self.busGains = None
+        self.buses = None
+
+    def clear(self):
+        self.__init__()
+
+    def mix(self, gains, level_syn, level_drum):
+        gains = np.asarray(gains, dtype = np.float32)
+        if self.busGains is None or not np.array_equal(gains, self.busGains):
+            # (2 x tracks) @ (tracks x samples), one BLAS call for both buses
+            busMatrix = np.stack([np.where(self.isDrum, 0, gains), np.where(self.isDrum, gains, 0)]).astype(np.float32)
+            self.buses = busMatrix @ self.stems
+            self.busGains = gains
+
+        mix = np.multiply(self.buses[0], np.float32(level_syn))
+        mix += np.float32(level_drum) * self.buses[1]
+        return mix
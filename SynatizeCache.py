@@ -0,0 +1,115 @@
+from os import path, makedirs, replace, remove, scandir, utime
+from hashlib import sha1
+import pickle
+
+from ma2_synatize import synatize, synatize_build
+
+
+class SynatizeCache:
+
+    # the output of synatize() / synatize_build() only depends on the .syn content, the stored randoms
+    # and the set of synths / drums that are actually used - so we keep it, in memory and on disk.
+    # entries are stored pickled, every hit hands out fresh copies nobody else holds a reference to.
+    # on disk, the least recently used entries go when the budget is exceeded (like the RenderCache).
+
+    sourceFiles = ['ma2_synatize.py', 'ma2_synatize_defaults.py']
+
+    def __init__(self, cachedir = None, budget = 64 << 20):
+        self.cachedir = path.join(cachedir, 'synatize') if cachedir is not None else None
+        self.budget = budget
+        self.memory = {}
+        self.hits = 0
+        self.misses = 0
+
+        # if aMaySyn itself changes, none of the old entries are any good
+        salt = sha1()
+        for sourceFile in self.sourceFiles:
+            if path.exists(sourceFile):
+                with open(sourceFile, 'rb') as f:
+                    salt.update(f.read())
+        self.salt = salt.hexdigest()
+
+    def hashOf(self, *parts):
+        digest = sha1(self.salt.encode())
+        for part in parts:
+            digest.update(part if isinstance(part, bytes) else repr(part).encode())
+        return digest.hexdigest()
+
+    def load(self, key):
+        # the payload and a fresh copy of what it holds, or None
+        if key in self.memory:
+            payload = self.memory[key]
+            return payload, pickle.loads(payload)
+        if self.cachedir is None:
+            return None
+        filename = path.join(self.cachedir, key + '.pickle')
+        if not path.exists(filename):
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                payload = f.read()
+            result = pickle.loads(payload)
+            utime(filename)
+        except Exception as e:
+            print("could not read synatize cache entry", filename, e)
+            return None
+        self.memory[key] = payload
+        return payload, result
+
+    def store(self, key, payload):
+        self.memory[key] = payload
+        if self.cachedir is None:
+            return
+        try:
+            makedirs(self.cachedir, exist_ok = True)
+            filename = path.join(self.cachedir, key + '.pickle')
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(payload)
+            replace(filename + '.tmp', filename)
+        except OSError as e:
+            print("could not write synatize cache entry", key, e)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in scandir(self.cachedir) if entry.name.endswith('.pickle'))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= self.budget:
+                break
+            try:
+                remove(filename)
+                total -= size
+            except OSError:
+                continue
+
+    def synatize(self, synFile, stored_randoms = [], reshuffle_randoms = False):
+        # returns the parse key (for synatize_build) and the usual synatize() tuple
+        with open(synFile, 'rb') as f:
+            content = f.read()
+
+        key = self.hashOf(content, stored_randoms)
+        entry = self.load(key) if not reshuffle_randoms else None
+        if entry is not None:
+            self.hits += 1
+            payload, result = entry
+        else:
+            self.misses += 1
+            result = synatize(synFile, stored_randoms = stored_randoms, reshuffle_randoms = reshuffle_randoms)
+            payload = pickle.dumps(result)
+            if not reshuffle_randoms:
+                self.store(key, payload)
+
+        # the build key has to follow what was actually parsed, this matters after reshuffling
+        return self.hashOf(payload), result
+
+    def synatize_build(self, parse_key, form_list, main_list, param_list, synths, drums):
+        key = self.hashOf(parse_key, sorted(synths, key = str), sorted(drums, key = str))
+        entry = self.load(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        result = synatize_build(form_list, main_list, param_list, synths, drums)
+        self.store(key, pickle.dumps(result))
+        return result
@@ -0,0 +1,63 @@
+from bisect import bisect_right
+from functools import lru_cache
+import numpy as np
+
+
+class TempoMap:
+
+    # the BPM string ("0:120 16:140 ...", beat:bpm) parsed once, with the time at every tempo change summed up already.
+    # gives the same numbers as the old getTimeOfBeat_raw(), which walked through all tempo changes on every call.
+
+    def __init__(self, bpmstring):
+        bpmdict = {float(part.split(':')[0]): float(part.split(':')[1]) for part in bpmstring.split()}
+        self.beats = list(bpmdict)
+        self.bpms = list(bpmdict.values())
+
+        self.times = [0.]
+        for b in range(len(self.beats) - 1):
+            self.times.append(self.times[-1] + (self.beats[b+1] - self.beats[b]) * 60./ self.bpms[b])
+
+        self.sorted = all(b0 < b1 for b0, b1 in zip(self.beats, self.beats[1:]))
+        self.beatArray = np.array(self.beats)
+        self.bpmArray = np.array(self.bpms)
+        self.timeArray = np.array(self.times)
+
+    def __repr__(self):
+        return 'TempoMap(' + ' '.join(f'{b:g}:{bpm:g}' for b, bpm in zip(self.beats, self.bpms)) + ')'
+
+    def segment(self, beat):
+        if self.sorted:
+            return min(max(bisect_right(self.beats, beat) - 1, 0), len(self.beats) - 1)
+        # nobody should write them unsorted, but this is what the old loop did then
+        for b in range(len(self.beats) - 1):
+            if beat < self.beats[b+1]:
+                return b
+        return len(self.beats) - 1
+
+    def timeOfBeat(self, beat):
+        beat = float(beat)
+        if beat < 0:
+            return 0
+        b = self.segment(beat)
+        return self.times[b] + (beat - self.beats[b]) * 60./ self.bpms[b]
+
+    def timesOfBeats(self, beats):
+        beats = np.asarray(beats, dtype = float)
+        if self.sorted:
+            b = np.clip(np.searchsorted(self.beatArray, beats, side = 'right') - 1, 0, len(self.beats) - 1)
+        else:
+            b = np.array([self.segment(beat) for beat in beats.ravel()], dtype = int).reshape(beats.shape)
+        times = self.timeArray[b] + (beats - self.beatArray[b]) * 60./ self.bpmArray[b]
+        return np.where(beats < 0, 0., times)
+
+    def beatOfTime(self, time):
+        # the other way round, e.g. for a playback cursor
+        if time <= 0 or not self.sorted:
+            return max(time, 0) * self.bpms[0] / 60.
+        b = max(bisect_right(self.times, time) - 1, 0)
+        return self.beats[b] + (time - self.times[b]) * self.bpms[b] / 60.
+
+
+@lru_cache(maxsize = 32)
+def tempoMap(bpmstring):
+    return TempoMap(bpmstring)
@@ -0,0 +1,86 @@
+from struct import pack
+import numpy as np
+
+
+class WavStreamWriter:
+
+    # writes interleaved float samples to a WAV file chunk by chunk, so the song never has to be in memory at once.
+    # the header reserves a JUNK chunk where the ds64 chunk goes if the file turns out to be > 4 GiB (RF64).
+
+    formats = {
+        'float32': (3, 32),
+        'int24': (1, 24),
+        'int16': (1, 16),
+    }
+
+    def __init__(self, filename, samplerate, channels = 2, sampleFormat = 'float32', dither = True):
+        if sampleFormat not in self.formats:
+            print("unknown WAV sample format", sampleFormat, "- use one of", ', '.join(self.formats))
+            raise ValueError
+        self.filename = filename
+        self.samplerate = samplerate
+        self.channels = channels
+        self.sampleFormat = sampleFormat
+        self.formatTag, self.bits = self.formats[sampleFormat]
+        self.blockAlign = self.channels * self.bits // 8
+        self.dither = dither and sampleFormat == 'int16'
+        self.random = np.random.default_rng()
+        self.dataSize = 0
+
+        self.file = open(filename, 'wb')
+        self.writeHeader()
+
+    def writeHeader(self):
+        self.file.seek(0)
+        # the pad byte after an odd sized data chunk belongs to the RIFF, but not to the data chunk
+        riffSize = self.headerSize() - 8 + self.dataSize + self.dataSize % 2
+        rf64 = riffSize > 0xFFFFFFFF
+        self.file.write((b'RF64' if rf64 else b'RIFF') + pack('<I', 0xFFFFFFFF if rf64 else riffSize) + b'WAVE')
+        if rf64:
+            self.file.write(b'ds64' + pack('<IQQQI', 28, riffSize, self.dataSize, self.frames(), 0))
+        else:
+            self.file.write(b'JUNK' + pack('<I', 28) + bytes(28))
+
+        fmt = pack('<HHIIHH', self.formatTag, self.channels, self.samplerate, self.samplerate * self.blockAlign, self.blockAlign, self.bits)
+        if self.formatTag == 3:
+            # non-PCM wants the cbSize and a fact chunk
+            self.file.write(b'fmt ' + pack('<I', len(fmt) + 2) + fmt + pack('<H', 0))
+            # in an RF64, the real count is in the ds64 chunk
+            self.file.write(b'fact' + pack('<II', 4, 0xFFFFFFFF if rf64 else self.frames()))
+        else:
+            self.file.write(b'fmt ' + pack('<I', len(fmt)) + fmt)
+        self.file.write(b'data' + pack('<I', 0xFFFFFFFF if rf64 else self.dataSize))
+
+    def headerSize(self):
+        return 12 + 36 + (8 + 18 + 12 if self.formatTag == 3 else 8 + 16) + 8
+
+    def frames(self):
+        return self.dataSize // self.blockAlign
+
+    def encode(self, samples):
+        if self.sampleFormat == 'float32':
+            return samples.astype('<f4', copy = False).tobytes()
+        if self.sampleFormat == 'int24':
+            scaled = np.clip(np.rint(samples * 8388607.), -8388608, 8388607).astype('<i4')
+            return scaled.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+        scaled = samples * 32767.
+        if self.dither:
+            # TPDF dither, +-1 LSB
+            scaled += self.random.random(scaled.size) - self.random.random(scaled.size)
+        return np.clip(np.rint(scaled), -32768, 32767).astype('<i2').tobytes()
+
+    def write(self, samples):
+        # samples: interleaved float32 (L, R, L, R, ...), exactly how the renderer lays them out
+        data = self.encode(np.asarray(samples, dtype = np.float32))
+        self.file.write(data)
+        self.dataSize += len(data)
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.dataSize % 2 != 0:
+            self.file.write(bytes(1))
+        self.writeHeader()
+        self.file.close()
+        self.file = None
+        print(f"WAV WRITTEN ({self.filename}, {self.sampleFormat}, {self.frames()} frames)")
@@ -1,11 +1,8 @@
 from PyQt5.QtWidgets import QApplication
-from PyQt5.QtCore import Qt, QByteArray
-from struct import pack, unpack
-from itertools import accumulate
-from copy import deepcopy
+from PyQt5.QtCore import QEventLoop
 from os import path, mkdir
-from scipy.io import wavfile
-from math import ceil, sqrt
+from math import floor
+from hashlib import sha1
 import datetime
 import re
 import numpy as np
@@ -13,13 +10,35 @@ import numpy as np
 from SFXGLWidget import SFXGLWidget
 from ma2_synatize import *
 from aMaySynClassPorts import *
+from aMaySynColumns import SongColumns
+from SynatizeCache import SynatizeCache
+from WavStreamWriter import WavStreamWriter
+from RenderCache import RenderCache
+from StemMixer import StemMixer
+import GLSLTools
+from TempoMap import tempoMap
+from ShaderTemplate import TemplateCache
+from ArtifactEmitter import ArtifactEmitter
+from BuildWorker import BuildCancelled
 
 class aMaySynBuilder:
 
     templateFile = "template.matzethemightyemperor"
+    textureHeaderFile = "template.textureheader"
+    # in the order they used to be replaced, a value may contain the placeholders after its own
+    templatePlaceholders = ["//DEFCODE", "//SYNCODE", "//DRUMSYNCODE", "DRUM_INDEX", "//PARAMCODE", "//FILTERCODE", "//LOOPCODE",
+                            "//BEATHEADER", "STEREO_DELAY", "LEVEL_SYN", "LEVEL_DRUM"]
+    halfFloatIntegerLimit = 2048
+    # what a build() leaves behind for executeShader() and the export. buildStems() puts it back after the stems
+    buildState = ['fragment_shader', 'fragment_shader_unoptimized', 'fragment_float_output', 'sequence', 'song_length',
+                  'render_context', 'render_modules', 'render_timing', 'module_shift', 'file_extra_information',
+                  'synatized_code_syn', 'synatized_code_drum', 'last_synatized_forms']
+    templateCache = TemplateCache() # re-read only when the files change, e.g. not on every auto-render
+    literalFixups = re.compile(r'(\+0\.)?-0\.\)|\+0\.\)') # the old .replace('-0.)', ')').replace('+0.)', ')'), in one pass
     shaderHeader = '#version 130\nuniform float iTexSize;\nuniform float iBlockOffset;\nuniform float iSampleRate;\n\n'
 
     outdir = './out/'
+    cachedir = './cache/'
 
     def __init__(self, parent, synFile = None, info = None, **kwargs):
         self.parent = parent
@@ -27,6 +46,12 @@ class aMaySynBuilder:
         self.info = info
 
         self.useSequenceTexture = True # if this is True: ignore 'shader' completely and use [self.fragment_shader, self.sequence]
+        self.useFloatOutput = False # if this is True (and the template knows FLOAT_OUTPUT): render float samples, no 16bit packing
+        self.fragment_float_output = False
+        self.wavFormat = 'float32' # float32, int24 or int16 (dithered)
+        self.optimizeShader = False # constant folding, dead branches, inlining (GLSLTools.optimize) after the purge
+        self.reportOptimization = False # also compile the unoptimized shader once, to compare the compile times
+        self.fragment_shader_unoptimized = None
 
         self.MODE_debug = False
         self.MODE_headless = False
@@ -41,11 +66,24 @@ class aMaySynBuilder:
         self.synatize_param_list = None
         self.last_synatized_forms = None
         self.stored_randoms = []
+        self.synatize_key = None
+        self.synatizeCache = SynatizeCache(self.cachedir)
         if self.aMaySynFileExists():
             self.aMaySynatize()
 
         self.fragment_shader = None
         self.sequence = []
+        self.cancelled = None # set by the BuildWorker: returns True when the running build() is not wanted anymore
+        self.artifacts = ArtifactEmitter()
+        self.renderer = None
+        self.rendering = False
+        self.progressiveStripRows = 32 # with progressive playback, Qt gets to run after every this many rows of a block
+        self.renderCache = RenderCache(self.cachedir)
+        self.stemMixer = StemMixer()
+        self.render_context = None
+        self.render_modules = None
+        self.render_timing = None
+        self.last_render = None
 
         # debug stuff
         self.extra_time_shift = 0
@@ -76,8 +114,8 @@ class aMaySynBuilder:
             raise FileNotFoundError
 
         # TODO: Exception Handling instead of just quitting!!
-        self.synatize_form_list, self.synatize_main_list, drumkit, self.stored_randoms, self.synatize_param_list \
-            = synatize(self.synFile, stored_randoms = self.stored_randoms, reshuffle_randoms = reshuffle_randoms)
+        self.synatize_key, (self.synatize_form_list, self.synatize_main_list, drumkit, self.stored_randoms, self.synatize_param_list) \
+            = self.synatizeCache.synatize(self.synFile, stored_randoms = self.stored_randoms, reshuffle_randoms = reshuffle_randoms)
 
         def_synths = ['D_Drums', 'G_GFX', '__None']
         self.synths = ['I_' + m['id'] for m in self.synatize_main_list if m['type']=='main']
@@ -87,7 +125,7 @@ class aMaySynBuilder:
         self.drumkit = def_drumkit + drumkit
 
         # TODO: might also require some exception handling, we'll see
-        _, _, _, _, self.last_synatized_forms = synatize_build(self.synatize_form_list, self.synatize_main_list, self.synatize_param_list, self.synths, self.drumkit)
+        _, _, _, _, self.last_synatized_forms = self.synatizeCache.synatize_build(self.synatize_key, self.synatize_form_list, self.synatize_main_list, self.synatize_param_list, self.synths, self.drumkit)
 
     def aMaySynFileExists(self):
         return self.synFile is not None and path.exists(self.synFile)
@@ -103,6 +141,10 @@ class aMaySynBuilder:
         else:
             return info
 
+    def checkCancelled(self):
+        if self.cancelled is not None and self.cancelled():
+            raise BuildCancelled
+
     def printIfDebug(self, *messages):
         if self.MODE_debug:
             print(*messages)
@@ -123,112 +165,77 @@ class aMaySynBuilder:
         beat = float(beat)
         if(type(bpmlist) != str):
             return beat * 60./bpmlist
+        return tempoMap(bpmlist).timeOfBeat(beat)
 
-        bpmdict = {float(part.split(':')[0]): float(part.split(':')[1]) for part in bpmlist.split()}
-        if beat < 0:
-            return 0
-        if len(bpmdict) == 1:
-            return beat * 60./bpmdict[0]
-        time = 0
-        for b in range(len(bpmdict) - 1):
-            last_B = [*bpmdict][b]
-            next_B = [*bpmdict][b+1]
-            if beat < next_B:
-                return time + (beat - last_B) * 60./ bpmdict[last_B]
-            else:
-                time += (next_B - last_B) * 60./ bpmdict[last_B]
-        return time + (beat - next_B) * 60./ bpmdict[next_B]
+    def getTempoMap(self, bpmlist = None):
+        return tempoMap(self.getInfo('BPM') if bpmlist is None else ' '.join(bpmlist))
 
 
 ############################################### BUILD #####################################################
 
-    def patternIndex(self, module_pattern, pattern_list):
-        for index, pattern in enumerate(pattern_list):
-            if pattern.name == module_pattern.name:
-                return index
-        print(f"pattern with name {module_pattern.name} not found in pattern list:\n", pattern_list)
-        raise ValueError
-
-    def build(self, tracks, patterns, renderWAV = False):
+    def packSequence(self, columns, indexColumns = ()):
+        # each column becomes one block of the texture, the whole texture is a single concatenate.
+        # float16 holds integers exactly only up to 2048, so if any of the index columns goes beyond that, it is float32 instead
+        dtype = '=f4' if any(np.max(columns[c], initial = 0) > self.halfFloatIntegerLimit for c in indexColumns) else '=f2'
+        tex = np.concatenate([np.asarray(column, dtype = np.float64).astype(dtype) for column in columns])
+        if tex.size % 2 != 0:
+            tex = np.append(tex, np.zeros(1, dtype = dtype))
+        return tex
+
+    def sequenceTextureHeader(self):
+        # the sequence is a GL_R16F / GL_R32F texture, SEQ_WIDTH values per row (see SFXGLWidget.setTextureFromSequence)
+        return f"uniform sampler2D iSequence;\n#define SEQ_WIDTH {SFXGLWidget.sequenceWidth}\n" \
+            + "float rfloat(int off){return texelFetch(iSequence, ivec2(off % SEQ_WIDTH, off / SEQ_WIDTH), 0).r;}\n"
+
+    def build(self, tracks, patterns, renderWAV = False, floatOutput = None, songLength = None):
         if not self.aMaySynFileExists():
             print(f"Tried to build GLSL without valid aMaySyn-File ({self.synFile}). No can't do.\n")
             raise FileNotFoundError
 
         offset = self.getInfo('B_offset')
         stop = self.getInfo('B_stop')
-        reduced_tracks = []
-        actually_used_patterns = []
-        actually_used_pattern_names = []
-        for track in tracks:
-            t = decodeTrack(track)
-            if t.modules and not t.mute:
-                t.modules = [m for m in t.modules if m.getModuleOff() > offset and m.getModuleOn() < stop]
-                if t.modules:
-                    reduced_tracks.append(t)
-                    for m in t.modules:
-                        if m.pattern.name not in actually_used_pattern_names:
-                            actually_used_patterns.append(m.pattern)
-                            actually_used_pattern_names.append(m.pattern.name)
-
-        tracks = reduced_tracks
-        patterns = actually_used_patterns
-        for n in actually_used_pattern_names:
+        song = SongColumns.fromMayson(tracks).reduced(offset, stop)
+        for n in song.pattern_names:
             print(n)
 
-        if len(tracks) == 0:
+        if song.nTracks() == 0:
             print("Nothing to play..!")
             return 'Empty track :P'
 
-        #tracks = [t for t in self.tracks if t.modules and not t.mute]
-        max_mod_off = min(max(t.getLastModuleOff() for t in tracks), self.getInfo('B_stop')) # TODO. this min() should be redundant, check again
-        loop_mode = self.getInfo('loop')
-
-        filename = self.getInfo('title') + '.glsl'
+        max_mod_off = self.getMaxModOff(song)
+        loop_mode = self.getLoopMode()
 
         #print('\nUSE TRACKS: ', tracks, '\nUSE PATTERNS: ', patterns, '\n')
 
-        # TODO: after several changes, I'm not sure whether this is now still required or makes any sense at all, even..!
-        self.module_shift = offset
-        if self.module_shift > 0:
-            for part in self.getInfo('BPM').split():
-                bpm_point = float(part.split(':')[0])
-                if bpm_point <= self.module_shift:
-                    bpm_list = ['0:' + part.split(':')[1]]
-                else:
-                    bpm_list.append(str(bpm_point - self.module_shift) + ':' + part.split(':')[1])
-                print(part, self.module_shift, bpm_list)
-        else:
-            bpm_list = self.getInfo('BPM').split()
-
-        if self.MODE_headless:
-            loop_mode = 'full'
+        bpm_list = self.getBPMList(offset)
 
-        track_sep = [0] + list(accumulate([len(t.modules) for t in tracks]))
-        pattern_sep = [0] + list(accumulate([len(p.notes) for p in patterns]))
+        track_sep = song.trackSep()
+        pattern_sep = song.patternSep()
 
         print('BPM LIST:', bpm_list)
 
-        nT  = str(len(tracks))
-        nM  = str(track_sep[-1])
-        nP  = str(len(patterns))
-        nN  = str(pattern_sep[-1])
+        nT  = str(song.nTracks())
+        nM  = str(song.nModules())
+        nP  = str(song.nPatterns())
+        nN  = str(song.nNotes())
 
-        print("track_sep =", track_sep)
-        print("pattern_sep =", pattern_sep)
+        print("track_sep =", track_sep.tolist())
+        print("pattern_sep =", pattern_sep.tolist())
 
-        gf = open(self.templateFile)
-        glslcode = gf.read()
-        gf.close()
+        template = self.templateCache.get(self.templateFile, self.templatePlaceholders)
 
+        self.checkCancelled()
         self.aMaySynatize(self.synFile)
-        actually_used_synths = set(t.getSynthName() for t in tracks if not t.getSynthType() == '_')
-        actually_used_drums = set(n.note_pitch for p in patterns if p.synth_type == 'D' for n in p.notes)
+        actually_used_synths = song.synthNames()
+        actually_used_drums = song.drumIndices()
 
         if self.MODE_debug: print("ACTUALLY USED:", actually_used_synths, actually_used_drums)
 
         self.synatized_code_syn, self.synatized_code_drum, paramcode, filtercode, self.last_synatized_forms = \
-            synatize_build(self.synatize_form_list, self.synatize_main_list, self.synatize_param_list, actually_used_synths, actually_used_drums)
+            self.synatizeCache.synatize_build(self.synatize_key, self.synatize_form_list, self.synatize_main_list, self.synatize_param_list, actually_used_synths, actually_used_drums)
+        print(f"SYNATIZE CACHE: {self.synatizeCache.hits} hits, {self.synatizeCache.misses} misses")
 
+        self.checkCancelled()
         self.file_extra_information = ''
         if self.MODE_headless:
             print("ACTUALLY USED SYNTHS:", actually_used_synths)
@@ -241,7 +248,7 @@ class aMaySynBuilder:
         syn_rel = []
         syn_pre = []
         drum_rel = [0]
-        max_rel = 0
+        max_rel = self.getMaxRelease(actually_used_synths)
         max_drum_rel = 0
         if self.MODE_debug: print(self.synatize_main_list)
         for m in self.synatize_main_list:
@@ -250,8 +257,6 @@ class aMaySynBuilder:
             if m['type'] == 'main':
                 syn_rel.append(rel)
                 syn_pre.append(pre)
-                if m['id'] in actually_used_synths:
-                    max_rel = max(max_rel, rel)
             elif m['type'] == 'maindrum':
                 drum_rel.append(rel)
                 max_drum_rel = max(max_drum_rel, rel)
@@ -277,7 +282,7 @@ class aMaySynBuilder:
 
         # construct arrays for beat / time correspondence
         pos_B = [B for B in (float(part.split(':')[0]) for part in bpm_list) if B < max_mod_off] + [max_mod_off]
-        pos_t = [self.getTimeOfBeat(B, bpm_list) for B in pos_B]
+        pos_t = [round(t, 4) for t in self.getTempoMap(bpm_list).timesOfBeats(pos_B).tolist()]
         pos_BPS = []
         pos_SPB = []
         for b in range(len(pos_B)-1):
@@ -293,12 +298,12 @@ class aMaySynBuilder:
         beatheader += 'const float pos_BPS[' + ntime_1 + '] = float[' + ntime_1 + '](' + ','.join(map(GLfloat, pos_BPS)) + ');\n'
         beatheader += 'const float pos_SPB[' + ntime_1 + '] = float[' + ntime_1 + '](' + ','.join(map(GLfloat, pos_SPB)) + ');'
 
-        self.song_length = self.getTimeOfBeat(max_mod_off, bpm_list)
-        if loop_mode == 'full':
-            self.song_length = self.getTimeOfBeat(max_mod_off + max_rel, bpm_list)
-
+        self.song_length = self.getSongLength(max_mod_off, max_rel, loop_mode, bpm_list, offset)
         time_offset = self.getTimeOfBeat(offset, bpm_list)
-        self.song_length -= time_offset
+
+        if songLength is not None:
+            # e.g. stems, which have to be exactly as long as the whole mix
+            self.song_length = songLength
 
         loopcode = ('time = mod(time, ' + GLfloat(self.song_length) + ');\n' + 4*' ') if loop_mode != 'none' else ''
 
@@ -310,154 +315,243 @@ class aMaySynBuilder:
         print("SONG LENGTH: ", self.song_length)
 
         # check for unused features
-        if all(n.note_pan == 0 for p in patterns for n in p.notes):
+        unused_features = song.unusedNoteFeatures()
+        if 'note_pan' in unused_features:
             print("HINT: you didn't use any note_pan, might want to remove manually")
-        if all(n.note_vel == 100 for p in patterns for n in p.notes):
+        if 'note_vel' in unused_features:
             print("HINT: you didn't use any note_vel (other than 1.0), might want to remove manually")
-        if all(n.note_slide == 0 for p in patterns for n in p.notes):
+        if 'note_slide' in unused_features:
             print("HINT: you didn't use any note_slide, might want to remove manually")
-        if all(n.note_aux == 0 for p in patterns for n in p.notes):
+        if 'note_aux' in unused_features:
             print("HINT: you didn't use any note_aux, might want to remove manually")
 
         print("START TEXTURE")
 
-        fmt = '@e'
-        tex = b''
-        tex += b''.join(pack(fmt, float(s)) for s in track_sep)
-        tex += b''.join(pack(fmt, float(t.getSynthIndex()+1)) for t in tracks)
-        tex += b''.join(pack(fmt, float(t.getNorm())) for t in tracks)
-        tex += b''.join(pack(fmt, float(syn_rel[t.getSynthIndex()])) for t in tracks)
-        tex += b''.join(pack(fmt, float(syn_pre[t.getSynthIndex()])) for t in tracks)
-        tex += b''.join(pack(fmt, float(syn_slide[t.getSynthIndex()])) for t in tracks)
-        tex += b''.join(pack(fmt, float(m.mod_on)) for t in tracks for m in t.modules)
-        tex += b''.join(pack(fmt, float(m.getModuleOff())) for t in tracks for m in t.modules)
-        tex += b''.join(pack(fmt, float(self.patternIndex(m.pattern, patterns))) for t in tracks for m in t.modules)
-        tex += b''.join(pack(fmt, float(m.transpose)) for t in tracks for m in t.modules)
-        tex += b''.join(pack(fmt, float(s)) for s in pattern_sep)
-        tex += b''.join(pack(fmt, float(n.note_on)) for p in patterns for n in p.notes)
-        tex += b''.join(pack(fmt, float(n.note_off)) for p in patterns for n in p.notes)
-        tex += b''.join(pack(fmt, float(n.note_pitch)) for p in patterns for n in p.notes)
-        tex += b''.join(pack(fmt, float(n.note_pan * .01)) for p in patterns for n in p.notes)
-        tex += b''.join(pack(fmt, float(n.note_vel * .01)) for p in patterns for n in p.notes)
-        tex += b''.join(pack(fmt, float(n.note_slide)) for p in patterns for n in p.notes)
-        tex += b''.join(pack(fmt, float(n.note_aux)) for p in patterns for n in p.notes)
-        tex += b''.join(pack(fmt, float(d)) for d in drum_rel)
-
-        while len(tex) % 4 != 0:
-            tex += bytes(1)
-        texlength = int(len(tex))
-
-        tex_s = int(ceil(sqrt(float(texlength)/4.)))
-        tex_n = int(ceil(texlength/2))
-
-        # Generate output header file
-        array = []
-        arrayf = []
-        for i in range(int(ceil(texlength/2))):
-            array += unpack('@H', tex[2*i:2*i+2])
-            arrayf += unpack(fmt, tex[2*i:2*i+2])
-
-        text = "// Generated by tx210 / aMaySyn (c) 2018 NR4&QM/Team210\n\n#ifndef SEQUENCE_H\n#define SEQUENCE_H\n\n"
-        text += f"// Data:\n//{', '.join(str(val) for val in arrayf)}\n"
-        text += f"const unsigned short sequence_texture[{tex_n}] = {{{','.join(str(val) for val in array)}}};\n"
-        text += f"const int sequence_texture_size = {tex_s};"
-        text += '\n#endif\n'
-
-        self.sequence = tex
-
-        # Write to file
-        with open("sequence.h", "wt") as f:
-            f.write(text)
-            f.close()
-
-        print("TEXTURE FILE WRITTEN (sequence.h)")
-
-        glslcode = glslcode\
-            .replace("//DEFCODE", defcode)\
-            .replace("//SYNCODE", self.synatized_code_syn)\
-            .replace("//DRUMSYNCODE", self.synatized_code_drum)\
-            .replace("DRUM_INDEX", drum_index)\
-            .replace("//PARAMCODE", paramcode)\
-            .replace("//FILTERCODE",filtercode)\
-            .replace("//LOOPCODE", loopcode)\
-            .replace("//BEATHEADER", beatheader)\
-            .replace("STEREO_DELAY", GLfloat(self.getInfo('stereo_delay')))\
-            .replace("LEVEL_SYN", GLfloat(self.getInfo('level_syn')))\
-            .replace("LEVEL_DRUM", GLfloat(self.getInfo('level_drum')))
-
-        glslcode = glslcode.replace('e+00','').replace('-0.)', ')').replace('+0.)', ')')
+        synth_index = song.tracks['synth_index']
+        columns = [
+            track_sep,
+            synth_index + 1,
+            song.tracks['par_norm'],
+            np.asarray(syn_rel)[synth_index],
+            np.asarray(syn_pre)[synth_index],
+            np.asarray(syn_slide)[synth_index],
+            song.modules['mod_on'],
+            song.modules['mod_off'],
+            song.modules['pattern'],
+            song.modules['transpose'],
+            pattern_sep,
+            song.notes['note_on'],
+            song.notes['note_off'],
+            song.notes['note_pitch'],
+            song.notes['note_pan'] * .01,
+            song.notes['note_vel'] * .01,
+            song.notes['note_slide'],
+            song.notes['note_aux'],
+            drum_rel,
+        ]
+        self.sequence = self.packSequence(columns, indexColumns = [0, 8, 10])
+        if self.sequence.dtype.itemsize == 4:
+            print(f"HINT: the sequence has indices above {self.halfFloatIntegerLimit}, using a float32 texture")
+
+        self.checkCancelled()
+        glslcode = template.substitute({
+            "//DEFCODE": defcode,
+            "//SYNCODE": self.synatized_code_syn,
+            "//DRUMSYNCODE": self.synatized_code_drum,
+            "DRUM_INDEX": drum_index,
+            "//PARAMCODE": paramcode,
+            "//FILTERCODE": filtercode,
+            "//LOOPCODE": loopcode,
+            "//BEATHEADER": beatheader,
+            "STEREO_DELAY": GLfloat(self.getInfo('stereo_delay')),
+            "LEVEL_SYN": GLfloat(self.getInfo('level_syn')),
+            "LEVEL_DRUM": GLfloat(self.getInfo('level_drum')),
+        })
+
+        glslcode = self.literalFixups.sub(')', glslcode.replace('e+00',''))
         glslcode = self.purgeExpendables(glslcode)
+        self.checkCancelled()
+        glslcode_unoptimized = glslcode
+        if self.optimizeShader:
+            glslcode = self.optimizeGLSL(glslcode)
 
-        with open("template.textureheader") as f:
-            texheadcode = f.read()
-            f.close()
+        texheadcode = self.templateCache.text(self.textureHeaderFile)
 
-        glslcode_frag = '#version 130\n' + glslcode.replace("//TEXTUREHEADER", texheadcode)
+        self.checkCancelled()
+        useFloatOutput = self.useFloatOutput if floatOutput is None else floatOutput
+        self.fragment_float_output = useFloatOutput and 'FLOAT_OUTPUT' in glslcode
+        if useFloatOutput and not self.fragment_float_output:
+            print("HINT: your template does not know about FLOAT_OUTPUT, falling back to the 16bit output")
 
-        filename_frag = 'sfx.frag'
+        frag_header = '#version 130\n' + ('#define FLOAT_OUTPUT\n' if self.fragment_float_output else '')
+        # sfx.frag keeps the texture header of the template (the RGBA8 layout of sequence.h), we render with our own
+        seqheadcode = self.sequenceTextureHeader()
+        glslcode_frag = frag_header + glslcode.replace("//TEXTUREHEADER", seqheadcode)
+        self.fragment_shader_unoptimized = frag_header + glslcode_unoptimized.replace("//TEXTUREHEADER", seqheadcode) \
+            if self.optimizeShader and self.reportOptimization else None
 
-        with open(filename_frag, 'w') as out_file:
-            out_file.write(glslcode_frag)
+        # sequence.h, sfx.frag and the standalone <title>.glsl are only written on export, see emitArtifacts()
+        self.artifacts.update(self.getInfo('title'), self.sequence, glslcode, frag_header, texheadcode, self.shaderHeader)
 
-        print(f"GLSL CODE WRITTEN ({filename_frag}) -- NR4-compatible fragment shader")
+        self.fragment_shader = glslcode_frag
 
-        # for "standalone" version
-        texcode = f"const float sequence_texture[{tex_n}] = float[{tex_n}]({','.join(map(GLfloat, arrayf))});\n"
+        # what a partial re-render (see getDirtyBlocks) has to agree on with the last render, apart from the sequence
+        self.render_context = sha1(repr((template.digest, self.synatize_key, self.stored_randoms, self.info, self.extra_time_shift,
+                                         loop_mode, self.song_length, time_offset, self.fragment_float_output)).encode()).hexdigest()
+        self.render_modules = song.moduleSignatures()
+        self.render_timing = (bpm_list, time_offset, loop_mode, np.asarray(syn_rel), np.asarray(syn_pre))
 
-        glslcode = self.shaderHeader + glslcode
+        # the standalone shader (with the whole sequence as a literal) only when it is what gets rendered
+        return glslcode_frag if self.useSequenceTexture else self.artifacts.text('standalone')
 
-        glslcode = glslcode.replace("//TEXCODE",texcode).replace('//TEXTUREHEADER', 'float rfloat(int off){return sequence_texture[off];}\n')
+    def saveBuildState(self):
+        return {name: getattr(self, name, None) for name in self.buildState}, self.artifacts.saveState()
 
-        with open(filename, "w") as out_file:
-            out_file.write(glslcode)
+    def restoreBuildState(self, state):
+        values, artifacts = state
+        for name, value in values.items():
+            setattr(self, name, value)
+        self.artifacts.restoreState(artifacts)
 
-        print("GLSL CODE WRITTEN (" + filename + ") - QM-compatible standalone fragment shader")
+    def emitArtifacts(self, names = None):
+        self.artifacts.emit(names)
 
-        self.fragment_shader = glslcode_frag
+    def getMaxModOff(self, song):
+        return min(float(song.lastModuleOffs().max()), self.getInfo('B_stop')) # TODO. this min() should be redundant, check again
+
+    def getLoopMode(self):
+        return 'full' if self.MODE_headless else self.getInfo('loop')
+
+    def getBPMList(self, offset):
+        # TODO: after several changes, I'm not sure whether this is now still required or makes any sense at all, even..!
+        self.module_shift = offset
+        if self.module_shift > 0:
+            for part in self.getInfo('BPM').split():
+                bpm_point = float(part.split(':')[0])
+                if bpm_point <= self.module_shift:
+                    bpm_list = ['0:' + part.split(':')[1]]
+                else:
+                    bpm_list.append(str(bpm_point - self.module_shift) + ':' + part.split(':')[1])
+                print(part, self.module_shift, bpm_list)
+        else:
+            bpm_list = self.getInfo('BPM').split()
+        return bpm_list
+
+    def getMaxRelease(self, actually_used_synths):
+        return max([float(m['release']) if 'release' in m else 0 for m in self.synatize_main_list if m['type'] == 'main' and m['id'] in actually_used_synths], default = 0)
+
+    def getSongLength(self, max_mod_off, max_rel, loop_mode, bpm_list, offset):
+        song_length = self.getTimeOfBeat(max_mod_off, bpm_list)
+        if loop_mode == 'full':
+            song_length = self.getTimeOfBeat(max_mod_off + max_rel, bpm_list)
+        return song_length - self.getTimeOfBeat(offset, bpm_list)
+
+    def buildStems(self, tracks, patterns, floatOutput = None, wavDir = '.', includeMuted = False, unityGain = False, songLength = None):
+        # one fragment shader + sequence per unmuted track, everything else stays as in the mix.
+        # returns plain dicts that can be sent to the stem render processes as they are.
+        # unityGain: par_norm, level_syn and level_drum are all 1, for the remix (see StemMixer)
+        # afterwards, the builder is left with the song as before (or as built here), not with the last stem
+        if songLength is None:
+            self.fragment_shader = None
+            self.build(tracks, patterns, floatOutput = floatOutput)
+            if self.fragment_shader is None:
+                return []
+            songLength = self.song_length
+
+        state = self.saveBuildState()
+        info = self.info
+        if unityGain:
+            self.info = dict(info, level_syn = 1, level_drum = 1)
+
+        stems = []
+        try:
+            for t, track in enumerate(tracks):
+                if track['mute'] and not includeMuted:
+                    continue
+                track = dict(track, mute = False, par_norm = 1 if unityGain else track['par_norm'])
+                self.fragment_shader = None
+                self.build([track], patterns, floatOutput = floatOutput, songLength = songLength)
+                if self.fragment_shader is None:
+                    continue
+                stems.append({
+                    'track': t,
+                    'name': track['name'],
+                    'shader': self.fragment_shader,
+                    'sequence': self.sequence,
+                    'float_output': self.fragment_float_output,
+                    'song_length': self.song_length,
+                    'wavFile': self.getStemFileName(t, track['name'], wavDir),
+                })
+        finally:
+            self.info = info
+            self.restoreBuildState(state)
+        return stems
+
+    def getStemFileName(self, index, name, wavDir = '.'):
+        name = re.sub('[^\\w\\-]+', '_', name).strip('_')
+        return path.join(wavDir, f"{self.getInfo('title')}_{index:02d}_{name}.wav")
 
-        return glslcode
+    def isDrumTrack(self, tDict):
+        return Track(name = tDict['name'], synths = tDict['synths'], synth = tDict['current_synth']).getSynthType() == 'D'
+
+    def remixSong(self, tracks, patterns, samplerate, texsize, floatOutput = None, renderWAV = False, audiobuffer = None):
+        # par_norm, mute, level_syn and level_drum are only gains, so with the stems of the last render they are remixed on the CPU.
+        # returns None if that is not possible, then do the usual build() / executeShader()
+        if not self.useSequenceTexture:
+            return None
+        offset = self.getInfo('B_offset')
+        song = SongColumns.fromMayson(tracks).reduced(offset, self.getInfo('B_stop'))
+        if song.nTracks() == 0:
+            return None
+        if 0 in song.drumIndices():
+            print("REMIX: the side chain couples the tracks, that is no plain gain. full render.")
+            return None
+
+        self.aMaySynatize(self.synFile)
+        song_length = self.getSongLength(self.getMaxModOff(song), self.getMaxRelease(song.synthNames()), self.getLoopMode(), self.getBPMList(offset), offset)
+        useFloatOutput = self.useFloatOutput if floatOutput is None else floatOutput
+        key = self.stemMixer.keyOf(tracks, patterns, self.info, self.synatize_key, self.stored_randoms, self.extra_time_shift, samplerate, texsize, useFloatOutput, song_length)
+
+        if not self.stemMixer.matches(key):
+            print("REMIX: render the stems first")
+            stems = self.buildStems(tracks, patterns, floatOutput = floatOutput, includeMuted = True, unityGain = True, songLength = song_length)
+            floatstems = [None] * len(tracks)
+            for stem in stems:
+                floatstems[stem['track']] = self.renderStem(stem, samplerate, texsize)
+                if floatstems[stem['track']] is None:
+                    self.stemMixer.clear()
+                    return None
+            self.stemMixer.setStems(key, floatstems, [self.isDrumTrack(t) for t in tracks])
+
+        starttime = datetime.datetime.now()
+        self.song_length = song_length
+        gains = [0 if t['mute'] else t['par_norm'] for t in tracks]
+        floatmusic = self.stemMixer.mix(gains, self.getInfo('level_syn'), self.getInfo('level_drum'))
+        print("REMIX time", str((datetime.datetime.now() - starttime).total_seconds()) + 's')
+
+        return self.useRenderedMusic(floatmusic, samplerate, texsize, renderWAV, audiobuffer)
+
+    def renderStem(self, stem, samplerate, texsize):
+        # in this process, into memory (and the render cache)
+        key = self.renderCache.keyOf(stem['shader'], stem['sequence'], samplerate, texsize, stem['song_length'], stem['float_output'])
+        floatmusic = self.renderCache.load(key)
+        if floatmusic is not None:
+            return floatmusic
+
+        renderer = self.getRenderer()
+        renderer.configure(duration = stem['song_length'], samplerate = samplerate, texsize = texsize, floatOutput = stem['float_output'])
+        renderer.setTextureFromSequence(stem['sequence'])
+        log = renderer.computeShader(stem['shader'])
+        if renderer.floatmusic is None:
+            print(f"STEM {stem['name']} FAILED:", log)
+            return None
+        self.renderCache.store(key, renderer.floatmusic)
+        return renderer.floatmusic
 
     def purgeExpendables(self, code):
         chars_before = len(code)
-        purged_code = ''
-
-        while True:
-            func_list = {}
-            for i,l in enumerate(code.splitlines()):
-                func_head = re.findall('(?<=float )\w*(?=[ ]*\(.*\))', l)
-                if func_head:
-                    func_list.update({func_head[0]:i})
-
-            print(func_list)
-
-            expendable = []
-            self.printIfDebug("The following functions will be purged")
-            for f in func_list.keys():
-                #print(f, code.count(f), len(re.findall(f + '[ \n]*\(', code)))
-                if len(re.findall(f + '[ \n]*\(', code)) == 1:
-                    f_from = code.find('float '+f)
-                    if f_from == -1: continue
-                    f_iter = f_from
-                    n_open = 0
-                    n_closed = 0
-                    while True:
-                        n_open += int(code[f_iter] == '{')
-                        n_closed += int(code[f_iter] == '}')
-                        f_iter += 1
-                        if n_open > 0 and n_closed == n_open: break
-
-                    expendable.append(code[f_from:f_iter])
-                    self.printIfDebug(f, 'line', func_list[f], '/', f_iter-f_from, 'chars')
-
-            for e in expendable: code = code.replace(e + '\n', '')
-
-            if code == purged_code:
-                break
-            else:
-                purged_code = code
-                self.printIfDebug('try to purge next iteration')
-
-        purged_code = re.sub('\n[\n]*\n', '\n\n', purged_code)
+        purged_code, purged = GLSLTools.purgeExpendables(code)
+        self.printIfDebug("The following functions were purged:", ', '.join(purged))
 
         chars_after = len(purged_code)
         print('// total purge of', chars_before-chars_after, 'chars.')
@@ -465,10 +559,44 @@ class aMaySynBuilder:
         return purged_code
 
 
-    def executeShader(self, shader, samplerate, texsize, renderWAV = False):
+    def optimizeGLSL(self, code):
+        chars_before = len(code)
+        optimized_code, stats = GLSLTools.optimize(code)
+        print(f"// optimized: {stats['folded']} constants folded, {stats['branches']} dead branches, {stats['inlined']} functions inlined,",
+              f"{chars_before} -> {len(optimized_code)} chars.")
+        return optimized_code
+
+    def reportCompileTimes(self, renderer):
+        # one extra compile of each, outside of the program cache
+        before = renderer.measureCompileTime(self.fragment_shader_unoptimized)
+        after = renderer.measureCompileTime(self.fragment_shader)
+        if before is not None and after is not None:
+            print(f"SHADER OPTIMIZATION: {len(self.fragment_shader_unoptimized)} -> {len(self.fragment_shader)} chars,",
+                  f"compile time {before:.3f}s -> {after:.3f}s")
+        self.fragment_shader_unoptimized = None
+
+    def getRenderer(self):
+        # one renderer for the whole session, it keeps its GL context, buffers and compiled programs
+        if self.renderer is None:
+            self.renderer = SFXGLWidget(self.parent, cachedir = self.cachedir)
+        return self.renderer
+
+    def releaseRenderer(self):
+        if self.renderer is not None:
+            self.renderer.destroy()
+            self.renderer = None
+
+    def executeShader(self, shader, samplerate, texsize, renderWAV = False, audiobuffer = None, wavFile = None):
         if not shader:
             print("you need to build() some shader before executeShader(). shady boi...")
             return None
+        if self.rendering:
+            print("still rendering the last one, hang on...")
+            return None
+
+        # a WAV export is an export of the shader, too
+        if renderWAV:
+            self.emitArtifacts()
 
         # TODO: would be really nice: option to not re-shuffle the last throw of randoms, but export these to WAV on choice... TODOTODOTODOTODO!
         # TODO LATER: great plans -- live looping ability (how bout midi input?)
@@ -482,45 +610,164 @@ class aMaySynBuilder:
 
         starttime = datetime.datetime.now()
 
-        glwidget = SFXGLWidget(self.parent, duration = self.song_length, samplerate = samplerate, texsize = texsize)
-        if self.useSequenceTexture and self.fragment_shader is not None:
-            glwidget.setTextureFromSequence(self.sequence)
-            glwidget.show()
-            log = glwidget.computeShader(self.fragment_shader)
-        else:
-            glwidget.show()
-            log = glwidget.computeShader(shader)
+        useTexture = self.useSequenceTexture and self.fragment_shader is not None
+        floatOutput = self.fragment_float_output and useTexture
+        renderKey = self.renderCache.keyOf(self.fragment_shader if useTexture else shader, self.sequence if useTexture else None, samplerate, texsize, self.song_length, floatOutput)
+        cached = self.renderCache.load(renderKey)
+        if cached is not None:
+            print("RENDER CACHE HIT", renderKey)
+            if useTexture:
+                self.last_render = {'context': (self.render_context, samplerate, texsize), 'modules': self.render_modules, 'floatmusic': cached}
+            return self.useRenderedMusic(cached, samplerate, texsize, renderWAV, audiobuffer, wavFile)
+
+        renderer = self.getRenderer()
+        # nobody plays a headless WAV render, so the song never has to be in memory as a whole
+        keepMusic = not (renderWAV and self.MODE_headless and audiobuffer is None)
+        renderer.configure(duration = self.song_length, samplerate = samplerate, texsize = texsize, floatOutput = floatOutput, keepMusic = keepMusic)
+
+        if useTexture and self.fragment_shader_unoptimized is not None:
+            self.reportCompileTimes(renderer)
+
+        dirtyBlocks = self.getDirtyBlocks(samplerate, texsize, renderer.nblocks) if useTexture and keepMusic else None
+        if dirtyBlocks is not None:
+            return self.executePartially(renderer, dirtyBlocks, renderKey, samplerate, texsize, renderWAV, audiobuffer, wavFile, starttime)
+
+        # progressive playback: the audio buffer takes every finished block, and Qt gets to play it after every strip
+        # of a block - a whole block can take longer to render than it plays, on a slow renderer
+        def pumpEvents():
+            QApplication.processEvents(QEventLoop.ExcludeUserInputEvents)
+
+        # WAV export: every finished block goes to disk right away. without keepMusic, the render cache gets them the same way
+        writer = None
+        cacheEntry = None
+        def writeBlock(block):
+            writer.write(renderer.musicBlock(block))
+            if cacheEntry is not None:
+                cacheEntry.write(renderer.musicBlock(block))
+
+        if audiobuffer is not None:
+            audiobuffer.follow(renderer)
+            renderer.stripRows = self.progressiveStripRows
+            renderer.stripRendered.connect(pumpEvents)
+        if renderWAV:
+            writer = WavStreamWriter(wavFile or self.getInfo('title') + '.wav', samplerate, sampleFormat = self.wavFormat)
+            if useTexture and not keepMusic:
+                cacheEntry = self.renderCache.streamed(renderKey, renderer.nblocks * renderer.blocksize * 2 * 4)
+            renderer.blockRendered.connect(writeBlock)
+        self.rendering = True
+        log = None
+        try:
+            if useTexture:
+                renderer.setTextureFromSequence(self.sequence)
+                log = renderer.computeShader(self.fragment_shader)
+            else:
+                renderer.setTextureFromSequence(None)
+                log = renderer.computeShader(shader)
+        finally:
+            self.rendering = False
+            if audiobuffer is not None:
+                renderer.stripRendered.disconnect(pumpEvents)
+                renderer.stripRows = 0
+                audiobuffer.unfollow()
+            if writer is not None:
+                renderer.blockRendered.disconnect(writeBlock)
+                writer.close()
+            if cacheEntry is not None:
+                if log == 'Success.':
+                    cacheEntry.commit()
+                else:
+                    cacheEntry.discard()
 
         print(log)
-        self.music = glwidget.music
-        self.fmusic = glwidget.floatmusic
-        glwidget.hide()
-        glwidget.destroy()
+        self.music = renderer.music
+        self.fmusic = renderer.floatmusic
 
-        if not self.music:
+        if not self.music and keepMusic:
             print('dämmit. music is empty.')
             return None
 
-        self.bytearray = QByteArray(self.music)
-
         endtime = datetime.datetime.now()
         el = endtime - starttime
 
         print("Execution time", str(el.total_seconds()) + 's')
 
-        if renderWAV:
-            floatmusic_L = []
-            floatmusic_R = []
-            for n, sample in enumerate(self.fmusic):
-                if n % 2 == 0:
-                    floatmusic_L.append(sample)
-                else:
-                    floatmusic_R.append(sample)
-            floatmusic_stereo = np.transpose(np.array([floatmusic_L, floatmusic_R], dtype = np.float32))
-            wavfile.write(self.getInfo('title') + '.wav', samplerate, floatmusic_stereo)
+        if keepMusic:
+            self.rememberRender(renderKey, samplerate, texsize, self.fmusic if useTexture else None)
+
+        if self.MODE_headless:
+            QApplication.quit()
 
+        # the float samples themselves (no copy), they support the buffer protocol for playback
+        return self.fmusic
+
+    def rememberRender(self, renderKey, samplerate, texsize, floatmusic):
+        self.renderCache.store(renderKey, floatmusic)
+        # the next render of the same song might only need a few of these blocks again
+        self.last_render = {'context': (self.render_context, samplerate, texsize), 'modules': self.render_modules, 'floatmusic': floatmusic} \
+            if floatmusic is not None else None
+
+    def getDirtyBlocks(self, samplerate, texsize, nblocks):
+        # the blocks that can sound different than in the last render, None if that is not comparable (-> render everything)
+        last = self.last_render
+        blocksize = texsize * texsize
+        if last is None or last['context'] != (self.render_context, samplerate, texsize) or len(last['floatmusic']) != 2 * nblocks * blocksize:
+            return None
+
+        bpm_list, time_offset, loop_mode, syn_rel, syn_pre = self.render_timing
+        time_shift = time_offset + max(self.extra_time_shift, 0)
+        # with looping, the padding after song_length is the beginning again
+        loop_shifts = [0, self.song_length] if loop_mode != 'none' else [0]
+        margin = .01
+
+        blocks = set()
+        for beat_from, beat_to in SongColumns.dirtyBeatRanges(last['modules'], self.render_modules, syn_rel, syn_pre):
+            time_from = self.getTimeOfBeat(max(beat_from, 0), bpm_list) - time_shift - margin
+            time_to = self.getTimeOfBeat(max(beat_to, 0), bpm_list) - time_shift + margin
+            for loop_shift in loop_shifts:
+                first = max(0, floor((time_from + loop_shift) * samplerate / blocksize))
+                last_block = min(nblocks - 1, floor((time_to + loop_shift) * samplerate / blocksize))
+                blocks.update(range(first, last_block + 1))
+
+        if len(blocks) >= nblocks:
+            return None
+        return sorted(blocks)
+
+    def executePartially(self, renderer, blocks, renderKey, samplerate, texsize, renderWAV, audiobuffer, wavFile, starttime):
+        print(f"PARTIAL RENDER: {len(blocks)} of {renderer.nblocks} blocks", blocks)
+        self.rendering = True
+        try:
+            renderer.setTextureFromSequence(self.sequence)
+            log = renderer.computeShader(self.fragment_shader, blocks = blocks, base = self.last_render['floatmusic'])
+        finally:
+            self.rendering = False
+        print(log)
+
+        if renderer.floatmusic is None:
+            if audiobuffer is not None:
+                audiobuffer.finish()
+            return None
+
+        print("Execution time", str((datetime.datetime.now() - starttime).total_seconds()) + 's')
+        self.rememberRender(renderKey, samplerate, texsize, renderer.floatmusic)
+        return self.useRenderedMusic(renderer.floatmusic, samplerate, texsize, renderWAV, audiobuffer, wavFile)
+
+    def useRenderedMusic(self, floatmusic, samplerate, texsize, renderWAV = False, audiobuffer = None, wavFile = None):
+        # same as after a render, for samples that did not come from the GPU just now (render cache, remix)
+        self.fmusic = floatmusic
+        self.music = memoryview(floatmusic).cast('B')
+
+        if audiobuffer is not None:
+            audiobuffer.setData(self.fmusic)
+            audiobuffer.finish()
+
+        if renderWAV:
+            writer = WavStreamWriter(wavFile or self.getInfo('title') + '.wav', samplerate, sampleFormat = self.wavFormat)
+            blocksize = 2 * texsize * texsize
+            for start in range(0, len(floatmusic), blocksize):
+                writer.write(floatmusic[start : start + blocksize])
+            writer.close()
 
         if self.MODE_headless:
             QApplication.quit()
 
-        return self.bytearray
+        return self.fmusic
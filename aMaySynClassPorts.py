@@ -3,18 +3,21 @@ from numpy import clip
 import random
 
 
-def decodeTrack(tDict):
+def decodeTrack(tDict, decoded = None):
     track = Track(
         name = tDict['name'],
         synths = tDict['synths'],
         synth = tDict['current_synth']
     )
-    track.modules = [Module(m['mod_on'], decodePattern(m['pattern']), m['transpose']) for m in tDict['modules']]
+    # with a memo dict (pattern name -> Pattern), all modules referencing the same pattern share one decoded Pattern
+    track.modules = [Module(m['mod_on'], decodePattern(m['pattern'], decoded), m['transpose']) for m in tDict['modules']]
     track.par_norm = tDict['par_norm']
     track.mute = tDict['mute']
     return track
 
-def decodePattern(pDict):
+def decodePattern(pDict, decoded = None):
+    if decoded is not None and pDict['name'] in decoded:
+        return decoded[pDict['name']]
     pattern = Pattern(
         name = pDict['name'],
         length = pDict['length'],
@@ -30,9 +33,43 @@ def decodePattern(pDict):
         note_slide = n['note_slide'],
         note_aux = n['note_aux']
         ) for n in pDict['notes']]
+    if decoded is not None:
+        decoded[pDict['name']] = pattern
     return pattern
 
 
+class PatternRegistry:
+
+    def __init__(self, pDicts = None):
+        self.names = []
+        self.dicts = []
+        self.lookup = {}
+        if pDicts is not None:
+            for pDict in pDicts:
+                self.intern(pDict)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.lookup
+
+    def __repr__(self):
+        return ','.join(self.names)
+
+    def intern(self, pDict):
+        index = self.lookup.get(pDict['name'])
+        if index is None:
+            index = len(self.names)
+            self.lookup[pDict['name']] = index
+            self.names.append(pDict['name'])
+            self.dicts.append(pDict)
+        return index
+
+    def index(self, name):
+        return self.lookup.get(name)
+
+
 class Track:
 
     synths = []
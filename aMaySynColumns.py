@@ -0,0 +1,235 @@
+from collections import Counter
+from hashlib import sha1
+import numpy as np
+
+from aMaySynClassPorts import Track, PatternRegistry
+
+# columnar ("struct of arrays") version of the song, built straight from the mayson dicts.
+# the Track / Module / Pattern / Note classes stay what you edit with, this is what the builder reads.
+
+TRACK_DTYPE = np.dtype([
+    ('synth_index', 'i4'),
+    ('par_norm', 'f8'),
+    ('mute', '?'),
+    ('mod_first', 'i8'),
+    ('mod_count', 'i8'),
+])
+
+MODULE_DTYPE = np.dtype([
+    ('track', 'i4'),
+    ('mod_on', 'f8'),
+    ('mod_off', 'f8'),
+    ('pattern', 'i4'),
+    ('transpose', 'f8'),
+])
+
+PATTERN_DTYPE = np.dtype([
+    ('length', 'f8'),
+    ('note_first', 'i8'),
+    ('note_count', 'i8'),
+])
+
+NOTE_DTYPE = np.dtype([
+    ('pattern', 'i4'),
+    ('note_on', 'f8'),
+    ('note_off', 'f8'),
+    ('note_pitch', 'i4'),
+    ('note_pan', 'i4'),
+    ('note_vel', 'i4'),
+    ('note_slide', 'f8'),
+    ('note_aux', 'f8'),
+])
+
+NOTE_FEATURE_DEFAULTS = {
+    'note_pan': 0,
+    'note_vel': 100,
+    'note_slide': 0,
+    'note_aux': 0,
+}
+
+
+class NoteRowCache:
+
+    # the decoded note rows per pattern name, with a copy of the notes they were decoded from.
+    # a lookup with different notes decodes again, the GUI import drops the names that have changed (invalidate)
+
+    def __init__(self):
+        self.entries = {}
+
+    def noteRows(self, pDict, p):
+        entry = self.entries.get(pDict['name'])
+        if entry is None or entry[0] != pDict['notes']:
+            entry = ([dict(n) for n in pDict['notes']], np.array(SongColumns.decodeNoteRows(pDict, 0), dtype = NOTE_DTYPE))
+            self.entries[pDict['name']] = entry
+        rows = entry[1].copy()
+        rows['pattern'] = p
+        return rows
+
+    def invalidate(self, names):
+        for name in names:
+            self.entries.pop(name, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class SongColumns:
+
+    noteRowCache = NoteRowCache()
+
+    def __init__(self, tracks, modules, patterns, notes, track_synths, registry, pattern_types):
+        self.tracks = tracks
+        self.modules = modules
+        self.patterns = patterns
+        self.notes = notes
+        self.track_synths = track_synths
+        self.registry = registry
+        self.pattern_names = registry.names
+        self.pattern_types = pattern_types
+
+    def __repr__(self):
+        return f"SongColumns({self.nTracks()} tracks, {self.nModules()} modules, {self.nPatterns()} patterns, {self.nNotes()} notes)"
+
+    @classmethod
+    def fromMayson(cls, tDicts):
+        track_rows = []
+        module_rows = []
+        track_synths = []
+        registry = PatternRegistry()
+        pattern_rows = []
+        pattern_types = []
+        note_rows = []
+        note_count = 0
+
+        for t, tDict in enumerate(tDicts):
+            first = len(module_rows)
+            for m in tDict['modules']:
+                pDict = m['pattern']
+                p = registry.index(pDict['name'])
+                if p is None:
+                    p = registry.intern(pDict)
+                    pattern_rows.append(cls.decodePatternRow(pDict, note_count))
+                    pattern_types.append(pDict['synth_type'])
+                    note_rows.append(cls.noteRowCache.noteRows(pDict, p))
+                    note_count += len(note_rows[-1])
+                module_rows.append((t, m['mod_on'], m['mod_on'] + pattern_rows[p][0], p, m['transpose']))
+
+            # only for the synth bookkeeping, the modules are not decoded into objects here
+            track = Track(name = tDict['name'], synths = tDict['synths'], synth = tDict['current_synth'])
+            track_synths.append(track.getSynthFullName())
+            track_rows.append((track.getSynthIndex(), tDict['par_norm'], tDict['mute'], first, len(module_rows) - first))
+
+        return cls(
+            np.array(track_rows, dtype = TRACK_DTYPE),
+            np.array(module_rows, dtype = MODULE_DTYPE),
+            np.array(pattern_rows, dtype = PATTERN_DTYPE),
+            np.concatenate(note_rows) if note_rows else np.array([], dtype = NOTE_DTYPE),
+            track_synths,
+            registry,
+            pattern_types
+        )
+
+    @staticmethod
+    def decodePatternRow(pDict, note_first):
+        length = pDict['length'] if pDict['length'] and pDict['length'] > 0 else 1
+        return (length, note_first, len(pDict['notes']))
+
+    @staticmethod
+    def decodeNoteRows(pDict, p):
+        return [(p,
+                 float(n['note_on']),
+                 float(n['note_on']) + float(n['note_len']),
+                 int(n['note_pitch']),
+                 int(n['note_pan']),
+                 int(n['note_vel']),
+                 float(n['note_slide']),
+                 float(n['note_aux'])
+                 ) for n in pDict['notes']]
+
+    def reduced(self, offset, stop):
+        # drop muted tracks, modules outside of [offset, stop] and all patterns that are not used anymore.
+        keep = (self.modules['mod_off'] > offset) & (self.modules['mod_on'] < stop) & ~self.tracks['mute'][self.modules['track']]
+        modules = self.modules[keep]
+
+        mod_count = np.bincount(modules['track'], minlength = len(self.tracks))
+        keep_track = mod_count > 0
+        track_remap = np.cumsum(keep_track) - 1
+        tracks = self.tracks[keep_track]
+        tracks['mod_count'] = mod_count[keep_track]
+        tracks['mod_first'] = np.cumsum(tracks['mod_count']) - tracks['mod_count']
+        modules['track'] = track_remap[modules['track']]
+
+        # patterns are renumbered in the order of their first use
+        used, first_use = np.unique(modules['pattern'], return_index = True)
+        used = used[np.argsort(first_use)]
+        pattern_remap = np.full(len(self.patterns), -1, dtype = np.int32)
+        pattern_remap[used] = np.arange(len(used))
+        modules['pattern'] = pattern_remap[modules['pattern']]
+
+        patterns = self.patterns[used]
+        note_index = np.repeat(patterns['note_first'] - (np.cumsum(patterns['note_count']) - patterns['note_count']), patterns['note_count']) \
+            + np.arange(patterns['note_count'].sum())
+        notes = self.notes[note_index]
+        notes['pattern'] = pattern_remap[notes['pattern']]
+        patterns['note_first'] = np.cumsum(patterns['note_count']) - patterns['note_count']
+
+        return SongColumns(
+            tracks,
+            modules,
+            patterns,
+            notes,
+            [s for s, k in zip(self.track_synths, keep_track) if k],
+            PatternRegistry(self.registry.dicts[p] for p in used),
+            [self.pattern_types[p] for p in used]
+        )
+
+    def nTracks(self):      return len(self.tracks)
+    def nModules(self):     return len(self.modules)
+    def nPatterns(self):    return len(self.patterns)
+    def nNotes(self):       return len(self.notes)
+
+    def trackSep(self):
+        return np.concatenate(([0], np.cumsum(self.tracks['mod_count'])))
+
+    def patternSep(self):
+        return np.concatenate(([0], np.cumsum(self.patterns['note_count'])))
+
+    def lastModuleOffs(self):
+        return self.modules['mod_off'][self.tracks['mod_first'] + self.tracks['mod_count'] - 1]
+
+    def synthNames(self):
+        return set(s[2:] for s in self.track_synths if s[0] != '_')
+
+    def drumIndices(self):
+        is_drum = np.array([t == 'D' for t in self.pattern_types] + [False])
+        return set(np.unique(self.notes['note_pitch'][is_drum[self.notes['pattern']]]).tolist())
+
+    def unusedNoteFeatures(self):
+        return [f for f, default in NOTE_FEATURE_DEFAULTS.items() if np.all(self.notes[f] == default)]
+
+    def moduleSignatures(self):
+        # one tuple per module with everything that decides how it sounds. the pattern indices are renumbered
+        # in every reduced(), so the notes go in by content
+        notes = self.notes.copy()
+        notes['pattern'] = 0
+        pattern_digests = [sha1(notes[first : first + count].tobytes()).hexdigest() + str(length)
+                           for length, first, count in self.patterns.tolist()]
+        track = self.tracks[self.modules['track']]
+        return list(zip(
+            track['synth_index'].tolist(),
+            track['par_norm'].tolist(),
+            self.modules['mod_on'].tolist(),
+            self.modules['mod_off'].tolist(),
+            self.modules['transpose'].tolist(),
+            [pattern_digests[p] for p in self.modules['pattern'].tolist()]
+        ))
+
+    @staticmethod
+    def dirtyBeatRanges(old_signatures, new_signatures, syn_rel, syn_pre):
+        # the beat ranges that sound different between the two, i.e. of every module that is only in one of them -
+        # from its predraw until the end of its release
+        old_count = Counter(old_signatures)
+        new_count = Counter(new_signatures)
+        changed = (old_count - new_count) + (new_count - old_count)
+        return [(mod_on - syn_pre[synth_index], mod_off + syn_rel[synth_index])
+                for synth_index, _, mod_on, mod_off, _, _ in changed]
@@ -19,7 +19,6 @@ from os import path
 from random import randint
 from shutil import move
 from functools import partial
-from time import sleep
 from copy import deepcopy
 from itertools import accumulate
 import json
@@ -27,8 +26,13 @@ import json
 from aSleaZynUI import Ui_MainWindow
 from aSleaZynModels import TrackModel, ModuleModel, PatternModel, NoteModel
 from aMaySynBuilder import aMaySynBuilder
+from aMaySynColumns import SongColumns
 from SFXGLWidget import SFXGLWidget
 from FileModifiedHandler import FileModifiedHandler
+from ProgressiveAudioBuffer import ProgressiveAudioBuffer
+from WavStreamWriter import WavStreamWriter
+from aSleaZynStems import StemExport
+from BuildWorker import BuildWorker
 
 
 class SleaZynth(QMainWindow):
@@ -72,8 +76,36 @@ class SleaZynth(QMainWindow):
             elif event.key() == Qt.Key_T:
                 self.renderWhateverWasLast()
 
+            elif event.key() == Qt.Key_P:
+                self.toggleProgressivePlayback()
+
+            elif event.key() == Qt.Key_F:
+                self.toggleFloatOutput()
+
+            elif event.key() == Qt.Key_B:
+                self.cycleWavFormat()
+
+            elif event.key() == Qt.Key_E:
+                self.renderStems()
+
+            elif event.key() == Qt.Key_M:
+                self.toggleRemixMode()
+
+            elif event.key() == Qt.Key_O:
+                self.toggleOptimizeShader()
+
+            elif event.key() == Qt.Key_G:
+                self.emitArtifacts()
+
 
     def closeEvent(self, event):
+        if self.stemExport is not None:
+            print("waiting for the stem export to finish...")
+            self.stemExport.wait()
+        if self.amaysyn is not None:
+            self.buildWorker.stop()
+            self.amaysyn.artifacts.flush()
+            self.amaysyn.releaseRenderer()
         QApplication.quit()
 
 
@@ -150,13 +182,23 @@ class SleaZynth(QMainWindow):
             'selectedTrack': 0,
             'selectedModule': 0,
             'extraTimeShift': 0,
+            'progressivePlayback': True,
+            'floatOutput': False,
+            'wavFormat': 'float32',
+            'renderCacheMB': 2048,
+            'remixMode': False,
+            'optimizeShader': False,
+            'reimportQuietTime': .5,
             }
         self.info = {}
         self.patterns = []
         self.synths = []
         self.drumkit = []
         self.amaysyn = None
+        self.buildWorker = None
+        self.stemExport = None
         self.fileObserver = None
+        self.fileHandler = None
 
     def loadAndImportMayson(self):
         name, _ = QFileDialog.getOpenFileName(self, 'Load MAYSON file', '', 'aMaySyn export *.mayson(*.mayson)')
@@ -168,52 +210,52 @@ class SleaZynth(QMainWindow):
         self.importMayson()
 
     def importMayson(self):
-        maysonData = {}
         try:
-            file = open(self.state['maysonFile'], 'r')
-            maysonData = json.load(file)
+            with open(self.state['maysonFile'], 'r') as file:
+                maysonData = json.load(file)
         except FileNotFoundError:
             print(f"{self.state['maysonFile']} could not be imported. make sure that it exists, or choose another one.")
             self.loadAndImportMayson()
+            return
         except json.decoder.JSONDecodeError:
-            print(f"{self.state['maysonFile']} is changing right now, pause for 1 sec...")
-            sleep(1)
-            self.importMayson()
-        finally:
-            file.close()
+            # no waiting here, with auto-reimport the file watcher delivers it once it is complete
+            print(f"{self.state['maysonFile']} is changing right now, try again in a moment.")
+            return
 
-        if maysonData == {}:
+        self.importMaysonData(maysonData)
+
+    def importMaysonData(self, maysonData):
+        if not maysonData:
             return
 
         self.info = maysonData['info']
         self.info.update({'title': self.state['title']})
-        if self.amaysyn is not None:
-            self.amaysyn.updateState(info = self.info)
-
-        self.trackModel.setTracks(maysonData['tracks'])
-        self.patternModel.setPatterns(maysonData['patterns'])
-        self.synthModel.setStringList(maysonData['synths'])
-        self.drumModel.setStringList(maysonData['drumkit'])
-
-        self.trackModel.layoutChanged.emit()
-        if self.state['selectedTrack'] >= self.trackModel.rowCount():
-            self.state['selectedTrack'] = 0
-        self.selectIndex(self.ui.trackList, self.trackModel, self.state['selectedTrack'])
-
-        if self.state['selectedModule'] >= self.moduleModel.rowCount():
-            self.state['selectedModule'] = 0
-        self.selectIndex(self.ui.moduleList, self.moduleModel, self.state['selectedModule'])
-
-        self.noteModel.layoutChanged.emit()
-        if self.noteModel.rowCount() > 0:
+        self.syncBuilder()
+
+        # only what has changed gets touched, so the views keep their selection and the caches the rest
+        changedTracks = self.trackModel.updateTracks(maysonData['tracks'])
+        changedPatterns = self.patternModel.updatePatterns(maysonData['patterns'])
+        SongColumns.noteRowCache.invalidate(changedPatterns)
+        if self.synthModel.stringList() != maysonData['synths']:
+            self.synthModel.setStringList(maysonData['synths'])
+        if self.drumModel.stringList() != maysonData['drumkit']:
+            self.drumModel.setStringList(maysonData['drumkit'])
+        if changedTracks or changedPatterns:
+            print("REIMPORTED:", ', '.join(sorted(changedTracks | changedPatterns)))
+
+        if self.trackModel.rowCount() > 0:
+            if not self.trackIndex().isValid():
+                if self.state['selectedTrack'] >= self.trackModel.rowCount():
+                    self.state['selectedTrack'] = 0
+                self.selectIndex(self.ui.trackList, self.trackModel, self.state['selectedTrack'])
+            elif self.track()['name'] in changedTracks:
+                self.trackLoad(self.trackIndex())
+
+        if self.pattern() is not None and self.pattern()['name'] in changedPatterns:
+            self.patternLoad(self.patternIndex())
+        if not self.noteIndex().isValid() and self.noteModel.rowCount() > 0:
             self.selectIndex(self.ui.noteList, self.noteModel, 0)
 
-        self.synthModel.layoutChanged.emit()
-
-        self.drumModel.layoutChanged.emit()
-        if self.drumIndex().isValid():
-            self.selectIndex(self.ui.drumList, self.drumModel, self.drumIndex().row())
-
         self.applyStateToUI()
 
 
@@ -246,16 +288,21 @@ class SleaZynth(QMainWindow):
         if only is None or only == 'B_stop':
             self.info['B_stop'] = self.ui.spinBStop.value()
         if only is None or only == 'level_syn':
-            self.info['level_syn'] == self.ui.spinLevelSyn.value()
+            self.info['level_syn'] = self.ui.spinLevelSyn.value()
         if only is None or only == 'level_drum':
-            self.info['level_drum'] == self.ui.spinLevelDrum.value()
+            self.info['level_drum'] = self.ui.spinLevelDrum.value()
         if only is None or only == 'writeWAV':
             self.state['writeWAV'] = self.ui.checkWriteWAV.isChecked()
         if only is None or only == 'extraTimeShift':
             self.state['extraTimeShift'] = self.ui.spinTimeShift.value()
 
-        if self.amaysyn is not None:
-            self.amaysyn.updateState(info = self.info, synFile = synFile)
+        self.syncBuilder()
+
+    def syncBuilder(self):
+        # a running build has its own copy of the info, the builder gets ours when it is done (see onBuilt)
+        if self.amaysyn is not None and self.buildWorker.tryLock():
+            self.amaysyn.updateState(info = self.info, synFile = self.state['synFile'])
+            self.buildWorker.unlock()
 
     def applyStateToUI(self):
         self.ui.editFilename.setText(self.state['maysonFile'])
@@ -298,6 +345,38 @@ class SleaZynth(QMainWindow):
         self.state['autoRender'] = checked
         self.autoSave()
 
+    def toggleProgressivePlayback(self):
+        self.state['progressivePlayback'] = not self.state['progressivePlayback']
+        print("progressive playback (start after first rendered block):", 'ON' if self.state['progressivePlayback'] else 'OFF')
+        self.autoSave()
+
+    def toggleFloatOutput(self):
+        self.state['floatOutput'] = not self.state['floatOutput']
+        print("float render target (needs FLOAT_OUTPUT in the template):", 'ON' if self.state['floatOutput'] else 'OFF')
+        self.autoSave()
+
+    def toggleOptimizeShader(self):
+        self.state['optimizeShader'] = not self.state['optimizeShader']
+        self.amaysyn.optimizeShader = self.state['optimizeShader']
+        # the first render after switching it on tells whether it is worth it
+        self.amaysyn.reportOptimization = self.state['optimizeShader']
+        print("GLSL optimization (constant folding, dead branches, inlining):", 'ON' if self.state['optimizeShader'] else 'OFF')
+        self.autoSave()
+
+    def toggleRemixMode(self):
+        self.state['remixMode'] = not self.state['remixMode']
+        print("remix mode (volume / mute / level changes without re-rendering the song):", 'ON' if self.state['remixMode'] else 'OFF')
+        if not self.state['remixMode']:
+            self.amaysyn.stemMixer.clear()
+        self.autoSave()
+
+    def cycleWavFormat(self):
+        formats = list(WavStreamWriter.formats)
+        current = formats.index(self.state['wavFormat']) if self.state['wavFormat'] in formats else -1
+        self.state['wavFormat'] = formats[(current + 1) % len(formats)]
+        print("WAV export format:", self.state['wavFormat'] + (' (dithered)' if self.state['wavFormat'] == 'int16' else ''))
+        self.autoSave()
+
     def toggleAutoReimport(self, checked):
         self.state['autoReimport'] = checked
         self.autoSave()
@@ -306,17 +385,26 @@ class SleaZynth(QMainWindow):
             self.fileObserver.stop()
             self.fileObserver.join()
             self.fileObserver = None
+            self.fileHandler.cancel()
+            self.fileHandler = None
 
         if checked:
             file = self.state['maysonFile']
-            eventHandler = FileModifiedHandler(file)
-            eventHandler.fileChanged.connect(self.importAndRender if self.state['autoRender'] else self.importMayson)
+            self.fileHandler = FileModifiedHandler(file, quietTime = self.state['reimportQuietTime'])
+            self.fileHandler.fileChanged.connect(self.onMaysonChanged)
             self.fileObserver = Observer()
-            self.fileObserver.schedule(eventHandler, path=path.dirname(file), recursive = False)
+            self.fileObserver.schedule(self.fileHandler, path=path.dirname(path.abspath(file)), recursive = False)
             self.fileObserver.start()
 
-    def importAndRender(self):
-        self.importMayson()
+    def onMaysonChanged(self, maysonData):
+        # already parsed by the file watcher
+        if self.state['autoRender']:
+            self.importAndRender(maysonData)
+        else:
+            self.importMaysonData(maysonData)
+
+    def importAndRender(self, maysonData):
+        self.importMaysonData(maysonData)
         if self.amaysyn is None:
             print("You want to Reimport&Render, but why is aMaySyn not initialized? do some rendering first!")
             return
@@ -496,7 +584,11 @@ class SleaZynth(QMainWindow):
         return self.ui.drumList.currentIndex()
 
     def synthRandomize(self):
+        if not self.buildWorker.tryLock():
+            print("still building, try again in a moment.")
+            return
         self.amaysyn.aMaySynatize(reshuffle_randoms = True)
+        self.buildWorker.unlock()
 
     def synthHardClone(self):
         if self.synth()[0] == 'D':
@@ -579,7 +671,9 @@ class SleaZynth(QMainWindow):
         self.loadSynthsFromSynFile()
 
     def loadSynthsFromSynFile(self):
-        self.amaysyn.aMaySynatize()
+        # the .syn has changed on disk, so this waits for a running build
+        with self.buildWorker.lock:
+            self.amaysyn.aMaySynatize()
         self.synthModel.setStringList(self.amaysyn.synths)
         self.synthModel.dataChanged.emit(self.synthModel.createIndex(0, 0), self.synthModel.createIndex(self.synthModel.rowCount(), 0))
         self.drumModel.setStringList(self.amaysyn.drumkit)
@@ -593,6 +687,11 @@ class SleaZynth(QMainWindow):
 
     def initAMaySyn(self):
         self.amaysyn = aMaySynBuilder(self, self.state['synFile'], self.info)
+        self.buildWorker = BuildWorker(self.amaysyn)
+        self.buildWorker.built.connect(self.onBuilt)
+        self.buildWorker.failed.connect(self.onBuildFailed)
+        self.amaysyn.renderCache.budget = self.state['renderCacheMB'] << 20
+        self.amaysyn.optimizeShader = self.state['optimizeShader']
 
     def initAudio(self):
         self.audioformat = QAudioFormat()
@@ -605,6 +704,13 @@ class SleaZynth(QMainWindow):
         self.audiooutput = QAudioOutput(self.audioformat)
         self.audiooutput.setVolume(1.0)
 
+    def initAudioBuffer(self):
+        # the audio buffer reads directly from the rendered float samples, there is no extra copy for playback
+        self.audiooutput.stop()
+        self.audiobuffer = ProgressiveAudioBuffer()
+        self.audiobuffer.open(QIODevice.ReadOnly)
+        self.audiobuffer.firstBlockReady.connect(partial(self.audiooutput.start, self.audiobuffer))
+
     def stopPlayback(self):
         self.audiooutput.stop()
 
@@ -619,48 +725,116 @@ class SleaZynth(QMainWindow):
     def renderModule(self):
         print(self.track(), self.module())
         self.state['lastRendered'] = 'module'
-        restoreMute = self.track()['mute']
-        self.track()['mute'] = False
         modInfo = deepcopy(self.info)
         modInfo['B_offset'] = self.module()['mod_on']
         modInfo['B_stop'] = self.module()['mod_on'] + self.module()['pattern']['length']
-        self.amaysyn.info = modInfo
-        self.amaysyn.extra_time_shift = self.state['extraTimeShift']
-        shader = self.amaysyn.build(tracks = [self.track()], patterns = [self.module()['pattern']])
-        self.amaysyn.info = self.info
-        self.track()['mute'] = restoreMute
-        self.executeShader(shader)
+        self.buildWorker.submit(tracks = [dict(self.track(), mute = False)], patterns = [self.module()['pattern']], info = modInfo,
+                                floatOutput = self.state['floatOutput'], extraTimeShift = self.state['extraTimeShift'])
 
     def renderTrack(self):
         self.state['lastRendered'] = 'track'
-        restoreMute = self.track()['mute']
-        self.track()['mute'] = False
-        self.amaysyn.extra_time_shift = self.state['extraTimeShift']
-        shader = self.amaysyn.build(tracks = [self.track()], patterns = self.patternModel.patterns)
-        self.track()['mute'] = restoreMute
-        self.executeShader(shader)
+        self.buildWorker.submit(tracks = [dict(self.track(), mute = False)], patterns = self.patternModel.patterns, info = self.info,
+                                floatOutput = self.state['floatOutput'], extraTimeShift = self.state['extraTimeShift'])
 
     def renderSong(self):
         self.state['lastRendered'] = 'song'
-        self.amaysyn.extra_time_shift = self.state['extraTimeShift']
-        shader = self.amaysyn.build(tracks = self.trackModel.tracks, patterns = self.patternModel.patterns)
-        self.executeShader(shader)
+        if self.state['remixMode'] and self.remixSong():
+            return
+        self.buildWorker.submit(tracks = self.trackModel.tracks, patterns = self.patternModel.patterns, info = self.info,
+                                floatOutput = self.state['floatOutput'], extraTimeShift = self.state['extraTimeShift'])
+
+    def onBuilt(self, generation, shader):
+        # back on the GUI thread. if there is a newer build coming (or already running), this one is not worth the GL time
+        if not self.buildWorker.isLatest(generation) or not self.buildWorker.tryLock():
+            return
+        try:
+            self.amaysyn.updateState(info = self.info, synFile = self.state['synFile'])
+            self.executeShader(shader)
+        finally:
+            self.buildWorker.unlock()
+
+    def emitArtifacts(self):
+        # sequence.h, sfx.frag and <title>.glsl of the last build
+        if not self.buildWorker.tryLock():
+            print("still building, try again in a moment.")
+            return
+        try:
+            self.amaysyn.emitArtifacts()
+        finally:
+            self.buildWorker.unlock()
+
+    def onBuildFailed(self, generation, message):
+        print(f"build {generation} failed:", message)
+
+    def remixSong(self):
+        # remix and stems still build on the GUI thread, but never while the worker is at it
+        if not self.buildWorker.tryLock():
+            print("still building, try again in a moment.")
+            return False
+        try:
+            self.amaysyn.updateState(info = self.info, synFile = self.state['synFile'])
+            self.amaysyn.extra_time_shift = self.state['extraTimeShift']
+            self.initAudioBuffer()
+            self.amaysyn.wavFormat = self.state['wavFormat']
+            floatmusic = self.amaysyn.remixSong(tracks = self.trackModel.tracks, patterns = self.patternModel.patterns, samplerate = self.samplerate, texsize = self.texsize,
+                                                floatOutput = self.state['floatOutput'], renderWAV = self.state['writeWAV'], audiobuffer = self.audiobuffer)
+        finally:
+            self.buildWorker.unlock()
+        return floatmusic is not None
+
+    def renderStems(self):
+        # every unmuted track on its own, as WAV next to the mix. does not touch lastRendered
+        if self.stemExport is not None:
+            print("still exporting the stems, one after the other please.")
+            return
+        if not self.buildWorker.tryLock():
+            print("still building, try again in a moment.")
+            return
+        try:
+            self.amaysyn.updateState(info = self.info, synFile = self.state['synFile'])
+            self.amaysyn.extra_time_shift = self.state['extraTimeShift']
+            stems = self.amaysyn.buildStems(tracks = self.trackModel.tracks, patterns = self.patternModel.patterns, floatOutput = self.state['floatOutput'])
+        finally:
+            self.buildWorker.unlock()
+        if not stems:
+            print("no stems to render.")
+            return
+        self.stemExport = StemExport(stems, self.samplerate, self.texsize, wavFormat = self.state['wavFormat'], cachedir = self.amaysyn.cachedir, parent = self)
+        self.stemExport.done.connect(self.onStemsDone)
+        self.stemExport.start()
+
+    def onStemsDone(self, failed):
+        self.stemExport.wait()
+        self.stemExport.deleteLater()
+        self.stemExport = None
+        if failed:
+            QMessageBox.warning(self, "STEMS", "These stems failed (see the console):\n" + '\n'.join(failed))
 
     def executeShader(self, shader):
+        # the compile time comparison is only for the first build after switching the optimization on
+        self.amaysyn.reportOptimization = False
         self.ui.codeEditor.clear()
         self.ui.codeEditor.insertPlainText(shader.replace(4*' ','\t').replace(3*' ', '\t'))
         self.ui.codeEditor.ensureCursorVisible()
 
+        # number of values (it used to count bytes). with the sequence texture, there is no such limit
         sequenceLength = len(self.amaysyn.sequence) if self.amaysyn.sequence is not None else 0
         if not self.amaysyn.useSequenceTexture and sequenceLength > pow(2, 14):
             QMessageBox.critical(self, "I CAN'T", f"Either switch to using the Sequence Texture (ask QM), or reduce the sequence size by limiting the offset/stop positions or muting tracks.\nCurrent sequence length is:\n{sequenceLength} > {pow(2,14)}")
             return
 
-        self.bytearray = self.amaysyn.executeShader(shader, self.samplerate, self.texsize, renderWAV = self.state['writeWAV'])
-        self.audiobuffer = QBuffer(self.bytearray)
-        self.audiobuffer.open(QIODevice.ReadOnly)
-        self.audiooutput.stop()
-        self.audiooutput.start(self.audiobuffer)
+        self.initAudioBuffer()
+
+        self.amaysyn.wavFormat = self.state['wavFormat']
+        if self.state['progressivePlayback']:
+            self.amaysyn.executeShader(shader, self.samplerate, self.texsize, renderWAV = self.state['writeWAV'], audiobuffer = self.audiobuffer)
+            return
+
+        floatmusic = self.amaysyn.executeShader(shader, self.samplerate, self.texsize, renderWAV = self.state['writeWAV'])
+        if floatmusic is None:
+            return
+        self.audiobuffer.setData(floatmusic)
+        self.audiobuffer.finish()
 
 
 ###################################### DEBUG STUFF #############################################
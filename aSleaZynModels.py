@@ -1,6 +1,58 @@
 from PyQt5.QtCore import QAbstractListModel, Qt, QModelIndex, pyqtSignal
+from collections import Counter
 from copy import deepcopy
 
+
+def rowKeys(rows):
+    # name plus occurrence, because names are not unique (e.g. after cloneRow)
+    seen = Counter()
+    keys = []
+    for row in rows:
+        keys.append((row['name'], seen[row['name']]))
+        seen[row['name']] += 1
+    return keys
+
+def syncRows(model, rows, newRows):
+    # turns rows (the list of the model, changed in place) into newRows with as few remove / move / insert / dataChanged as possible.
+    # rows are matched by name and compared by content. returns the names of everything that is new, changed or gone
+    parent = QModelIndex()
+    changed = set()
+    keys = rowKeys(rows)
+    newKeys = rowKeys(newRows)
+
+    wanted = set(newKeys)
+    for i in reversed(range(len(rows))):
+        if keys[i] not in wanted:
+            model.beginRemoveRows(parent, i, i)
+            changed.add(keys[i][0])
+            del rows[i], keys[i]
+            model.endRemoveRows()
+
+    for i, (key, row) in enumerate(zip(newKeys, newRows)):
+        if i < len(keys) and keys[i] == key:
+            pass
+        elif key in keys:
+            j = keys.index(key, i)
+            model.beginMoveRows(parent, j, j, parent, i)
+            rows.insert(i, rows.pop(j))
+            keys.insert(i, keys.pop(j))
+            model.endMoveRows()
+        else:
+            model.beginInsertRows(parent, i, i)
+            rows.insert(i, row)
+            keys.insert(i, key)
+            model.endInsertRows()
+            changed.add(key[0])
+            continue
+
+        if rows[i] != row:
+            rows[i] = row
+            model.dataChanged.emit(model.createIndex(i, 0), model.createIndex(i, 0))
+            changed.add(key[0])
+
+    return changed
+
+
 class TrackModel(QAbstractListModel):
 
     def __init__ (self, *args, **kwargs):
@@ -13,6 +65,9 @@ class TrackModel(QAbstractListModel):
         self.layoutChanged.emit()
         self.endRemoveRows()
 
+    def updateTracks(self, tracks):
+        return syncRows(self, self.tracks, tracks)
+
     def data(self, index, role):
         i = index.row()
         if role == Qt.DisplayRole:
@@ -76,6 +131,9 @@ class PatternModel(QAbstractListModel):
         self.layoutChanged.emit()
         self.endRemoveRows()
 
+    def updatePatterns(self, patterns):
+        return syncRows(self, self.patterns, patterns)
+
     def data(self, index, role):
         i = index.row()
         if role == Qt.DisplayRole:
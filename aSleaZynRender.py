@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+###########################################################
+#
+#   aSleaZynRender - render .mayson files to WAV without any UI.
+#   one offscreen GL context for all of them, so it is fine for whole compo packs.
+#
+#   usage:
+#       aSleaZynRender.py song.mayson other.mayson,other_synths.syn ...
+#       aSleaZynRender.py --manifest nightly.txt --outdir ./out/ --format int16
+#       aSleaZynRender.py song.mayson --stems --jobs 32
+#
+#   a manifest has one "file.mayson [file.syn]" per line, # starts a comment.
+#
+###########################################################
+
+import os
+import sys
+import json
+import argparse
+import datetime
+
+# has to be set before the QApplication exists. no windows, no X server needed
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtWidgets import QApplication
+
+from aMaySynBuilder import aMaySynBuilder
+from WavStreamWriter import WavStreamWriter
+from aSleaZynStems import renderStems
+
+
+def getTitleAndSynFromMayson(maysonFile):
+    # same as in SleaZynth
+    synFile = '.'.join(maysonFile.split('.')[:-1]) + '.syn'
+    title = '.'.join(os.path.basename(maysonFile).split('.')[:-1])
+    return title, synFile
+
+def parseJob(spec):
+    maysonFile, _, synFile = spec.partition(',')
+    title, defaultSynFile = getTitleAndSynFromMayson(maysonFile)
+    return maysonFile, synFile or defaultSynFile, title
+
+def readManifest(manifestFile):
+    jobs = []
+    with open(manifestFile) as f:
+        for line in f:
+            line = line.split('#')[0].split()
+            if not line:
+                continue
+            jobs.append(parseJob(','.join(line[:2])))
+    return jobs
+
+def renderJob(amaysyn, maysonFile, synFile, title, args):
+    with open(maysonFile) as f:
+        maysonData = json.load(f)
+
+    info = maysonData['info']
+    info.update({'title': title})
+    amaysyn.updateState(info = info, synFile = synFile, stored_randoms = [])
+    amaysyn.aMaySynatize()
+
+    starttime = datetime.datetime.now()
+    amaysyn.fragment_shader = None
+    shader = amaysyn.build(tracks = maysonData['tracks'], patterns = maysonData['patterns'], floatOutput = args.float)
+    if amaysyn.fragment_shader is None:
+        print(f"{maysonFile}: nothing to render.")
+        return False
+    buildtime = datetime.datetime.now()
+
+    wavFile = os.path.join(args.outdir, title + '.wav')
+    amaysyn.executeShader(shader, args.samplerate, args.texsize, renderWAV = True, wavFile = wavFile)
+    endtime = datetime.datetime.now()
+
+    print(f"{maysonFile}: build {(buildtime - starttime).total_seconds():.2f}s, render {(endtime - buildtime).total_seconds():.2f}s, "
+          + f"{amaysyn.song_length:.1f}s of music -> {wavFile}")
+
+    if args.stems:
+        stems = amaysyn.buildStems(tracks = maysonData['tracks'], patterns = maysonData['patterns'], floatOutput = args.float, wavDir = args.outdir)
+        if renderStems(stems, args.samplerate, args.texsize, wavFormat = args.format, workers = args.jobs, cachedir = amaysyn.cachedir):
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'render .mayson files to WAV, headless.')
+    parser.add_argument('files', nargs = '*', help = 'file.mayson or file.mayson,file.syn (default: the .syn next to the .mayson)')
+    parser.add_argument('--manifest', help = 'text file with one "file.mayson [file.syn]" per line')
+    parser.add_argument('--outdir', default = '.', help = 'where the WAV files go')
+    parser.add_argument('--format', default = 'float32', choices = list(WavStreamWriter.formats), help = 'WAV sample format')
+    parser.add_argument('--samplerate', type = int, default = 44100)
+    parser.add_argument('--texsize', type = int, default = 512)
+    parser.add_argument('--float', action = 'store_true', help = 'float render target (needs FLOAT_OUTPUT in the template)')
+    parser.add_argument('--optimize', action = 'store_true', help = 'constant folding, dead branches and inlining on the shader')
+    parser.add_argument('--report-optimization', action = 'store_true', help = 'with --optimize: compare size and compile time to the unoptimized shader')
+    parser.add_argument('--render-cache-mb', type = int, default = 2048, help = 'size of the render cache, 0 turns it off')
+    parser.add_argument('--stems', action = 'store_true', help = 'also render every unmuted track on its own, in parallel')
+    parser.add_argument('--jobs', type = int, default = None, help = 'number of stem render processes (default: one per core)')
+    args = parser.parse_args()
+
+    jobs = [parseJob(spec) for spec in args.files]
+    if args.manifest:
+        jobs.extend(readManifest(args.manifest))
+    if not jobs:
+        parser.print_usage()
+        return 2
+
+    os.makedirs(args.outdir, exist_ok = True)
+
+    app = QApplication(sys.argv)
+    amaysyn = aMaySynBuilder(None)
+    amaysyn.MODE_headless = True
+    amaysyn.wavFormat = args.format
+    amaysyn.renderCache.budget = args.render_cache_mb << 20
+    amaysyn.optimizeShader = args.optimize
+    amaysyn.reportOptimization = args.report_optimization
+
+    failed = []
+    totaltime = datetime.datetime.now()
+    try:
+        for maysonFile, synFile, title in jobs:
+            try:
+                if not renderJob(amaysyn, maysonFile, synFile, title, args):
+                    failed.append(maysonFile)
+            except Exception as e:
+                print(f"{maysonFile}: FAILED ({type(e).__name__}: {e})")
+                failed.append(maysonFile)
+    finally:
+        amaysyn.artifacts.flush()
+        amaysyn.releaseRenderer()
+
+    print(f"rendered {len(jobs) - len(failed)} of {len(jobs)} files in {(datetime.datetime.now() - totaltime).total_seconds():.2f}s")
+    if failed:
+        print("failed:", ' '.join(failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
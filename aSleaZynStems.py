@@ -0,0 +1,110 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PyQt5.QtGui import QGuiApplication
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from SFXGLWidget import SFXGLWidget
+from WavStreamWriter import WavStreamWriter
+
+# stem export: the stems are built in the calling process (aMaySynBuilder.buildStems), then rendered in parallel,
+# one worker process per CPU core, each with its own offscreen GL context and renderer.
+# the UI runs renderStems() in a StemExport thread, aSleaZynRender.py just calls it.
+
+workerApp = None
+workerRenderer = None
+
+def initWorker(cachedir, threads):
+    global workerApp, workerRenderer
+    # has to happen before the first context is created. llvmpipe would otherwise start one thread per core in every worker
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    os.environ.setdefault('LP_NUM_THREADS', str(threads))
+
+    workerApp = QGuiApplication(['aSleaZynStems'])
+    workerRenderer = SFXGLWidget(cachedir = cachedir)
+
+def renderStem(stem, samplerate, texsize, wavFormat):
+    starttime = time.perf_counter()
+    renderer = workerRenderer
+    # nobody listens to the stems here, they go to disk block by block
+    renderer.configure(duration = stem['song_length'], samplerate = samplerate, texsize = texsize, floatOutput = stem['float_output'], keepMusic = False)
+
+    writer = WavStreamWriter(stem['wavFile'], samplerate, sampleFormat = wavFormat)
+    def writeBlock(block):
+        writer.write(renderer.musicBlock(block))
+
+    renderer.blockRendered.connect(writeBlock)
+    try:
+        renderer.setTextureFromSequence(stem['sequence'])
+        log = renderer.computeShader(stem['shader'])
+    finally:
+        renderer.blockRendered.disconnect(writeBlock)
+        writer.close()
+
+    return log, time.perf_counter() - starttime
+
+def discardStem(stem):
+    # a stem that failed (or whose worker died) would leave a WAV with nothing but a header, or half of the song
+    try:
+        os.remove(stem['wavFile'])
+        print("removed the unfinished", stem['wavFile'])
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print("could not remove the unfinished", stem['wavFile'], e)
+
+def renderStems(stems, samplerate, texsize, wavFormat = 'float32', workers = None, cachedir = None):
+    if not stems:
+        print("no stems to render.")
+        return []
+
+    cores = os.cpu_count() or 1
+    workers = min(len(stems), workers or cores)
+    threads = max(1, cores // workers)
+    print(f"rendering {len(stems)} stems in {workers} processes ({threads} llvmpipe threads each)")
+
+    starttime = time.perf_counter()
+    failed = []
+    # spawn, not fork - a forked Qt / GL process is asking for trouble
+    with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('spawn'),
+                             initializer = initWorker, initargs = (cachedir, threads)) as pool:
+        futures = {pool.submit(renderStem, stem, samplerate, texsize, wavFormat): stem for stem in stems}
+        for future in as_completed(futures):
+            stem = futures[future]
+            try:
+                log, seconds = future.result()
+            except Exception as e:
+                log, seconds = f"{type(e).__name__}: {e}", 0
+            if log != 'Success.':
+                print(f"STEM {stem['name']} FAILED:", log)
+                failed.append(stem['name'])
+                discardStem(stem)
+            else:
+                print(f"STEM {stem['name']} DONE in {seconds:.2f}s -> {stem['wavFile']}")
+
+    print(f"{len(stems) - len(failed)} of {len(stems)} stems rendered in {time.perf_counter() - starttime:.2f}s")
+    return failed
+
+
+class StemExport(QThread):
+
+    # renderStems() without blocking the UI: the waiting on the worker processes happens in here.
+    # done carries the names of the stems that failed (queued to the GUI thread)
+
+    done = pyqtSignal(list)
+
+    def __init__(self, stems, samplerate, texsize, wavFormat = 'float32', workers = None, cachedir = None, parent = None):
+        super().__init__(parent)
+        self.args = (stems, samplerate, texsize, wavFormat, workers, cachedir)
+
+    def run(self):
+        try:
+            failed = renderStems(*self.args)
+        except Exception as e:
+            # e.g. the pool could not even start
+            print(f"stem export failed: {type(e).__name__}: {e}")
+            for stem in self.args[0]:
+                discardStem(stem)
+            failed = [stem['name'] for stem in self.args[0]]
+        self.done.emit(failed)
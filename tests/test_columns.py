@@ -0,0 +1,105 @@
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from aMaySynClassPorts import decodeTrack
+from aMaySynColumns import SongColumns
+
+
+def randomSong(rnd, ntracks = 6, npatterns = 8):
+    synths = ['I_bass', 'I_lead', 'D_Drums', 'G_GFX', '__None']
+    patterns = [{
+        'name': f'pattern{p}',
+        'length': rnd.choice([0, 1, 2, 4, 8]),
+        'synth_type': rnd.choice(['I', 'D']),
+        'max_note': 88,
+        'notes': [{
+            'note_on': rnd.randint(0, 15) / 4.,
+            'note_len': rnd.randint(1, 8) / 4.,
+            'note_pitch': rnd.randint(0, 87),
+            'note_pan': rnd.choice([0, 0, -20, 30]),
+            'note_vel': rnd.choice([100, 100, 64]),
+            'note_slide': rnd.choice([0, 0, .5]),
+            'note_aux': rnd.choice([0, 0, 3]),
+        } for _ in range(rnd.randint(0, 6))],
+    } for p in range(npatterns)]
+
+    tracks = []
+    for t in range(ntracks):
+        mod_on = 0
+        modules = []
+        for _ in range(rnd.randint(0, 5)):
+            mod_on += rnd.randint(0, 8)
+            modules.append({'mod_on': mod_on, 'pattern': rnd.choice(patterns), 'transpose': rnd.randint(-12, 12)})
+        tracks.append({
+            'name': f'track{t}',
+            'synths': synths,
+            'current_synth': rnd.randrange(len(synths)),
+            'modules': modules,
+            'par_norm': rnd.choice([1., .5]),
+            'mute': rnd.random() < .2,
+        })
+    return tracks
+
+def objectReduced(tDicts, offset, stop):
+    # what build() did before the columns: decode everything, drop muted tracks and modules outside of [offset, stop]
+    tracks = []
+    patterns = []
+    for tDict in tDicts:
+        t = decodeTrack(tDict)
+        if t.modules and not t.mute:
+            t.modules = [m for m in t.modules if m.getModuleOff() > offset and m.getModuleOn() < stop]
+            if t.modules:
+                tracks.append(t)
+                for m in t.modules:
+                    if m.pattern.name not in [p.name for p in patterns]:
+                        patterns.append(m.pattern)
+    return tracks, patterns
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_reduced_matches_object_path(seed):
+    rnd = random.Random(seed)
+    tDicts = randomSong(rnd)
+    offset = rnd.choice([0, 0, 2, 5])
+    stop = rnd.choice([1000, 12, 20])
+
+    song = SongColumns.fromMayson(tDicts).reduced(offset, stop)
+    tracks, patterns = objectReduced(tDicts, offset, stop)
+
+    assert song.nTracks() == len(tracks)
+    assert song.pattern_names == [p.name for p in patterns]
+    assert song.track_synths == [t.getSynthFullName() for t in tracks]
+    assert song.tracks['synth_index'].tolist() == [t.getSynthIndex() for t in tracks]
+    assert song.tracks['par_norm'].tolist() == [t.par_norm for t in tracks]
+
+    sep = song.trackSep()
+    for t, track in enumerate(tracks):
+        modules = song.modules[sep[t]:sep[t+1]]
+        assert modules['mod_on'].tolist() == [m.mod_on for m in track.modules]
+        assert modules['mod_off'].tolist() == [m.getModuleOff() for m in track.modules]
+        assert modules['transpose'].tolist() == [m.transpose for m in track.modules]
+        assert [song.pattern_names[p] for p in modules['pattern']] == [m.pattern.name for m in track.modules]
+
+    if tracks:
+        assert song.lastModuleOffs().tolist() == [t.getLastModuleOff() for t in tracks]
+
+    psep = song.patternSep()
+    for p, pattern in enumerate(patterns):
+        assert song.patterns['length'][p] == pattern.length
+        notes = song.notes[psep[p]:psep[p+1]]
+        assert (notes['pattern'] == p).all()
+        assert notes[['note_on', 'note_off', 'note_pitch', 'note_pan', 'note_vel', 'note_slide', 'note_aux']].tolist() \
+            == [(n.note_on, n.note_off, n.note_pitch, n.note_pan, n.note_vel, n.note_slide, n.note_aux) for n in pattern.notes]
+
+def test_reduced_drops_everything_muted():
+    tDicts = randomSong(random.Random(210))
+    for tDict in tDicts:
+        tDict['mute'] = True
+    song = SongColumns.fromMayson(tDicts).reduced(0, 1000)
+    assert song.nTracks() == 0
+    assert song.nModules() == 0
+    assert song.nPatterns() == 0
+    assert song.nNotes() == 0
@@ -0,0 +1,105 @@
+# syncRows(): the model ends up with the new rows, and the remove / move / insert / dataChanged it emits on the way
+# describe exactly that - replayed on a copy of the old rows, they have to give the new ones.
+
+import random
+from copy import deepcopy
+
+import pytest
+
+pytest.importorskip('PyQt5')
+from PyQt5.QtCore import QPersistentModelIndex
+
+from aSleaZynModels import PatternModel
+
+
+def pattern(name, length = 4, notes = 0):
+    return {'name': name, 'length': length, 'notes': [[0, 1, 24 + n] for n in range(notes)]}
+
+class Replay:
+
+    # applies the signals of the model to its own copy of the rows
+    def __init__(self, model):
+        self.model = model
+        self.rows = deepcopy(model.patterns)
+        self.signals = []
+        model.rowsRemoved.connect(self.removed)
+        model.rowsMoved.connect(self.moved)
+        model.rowsInserted.connect(self.inserted)
+        model.dataChanged.connect(self.dataChanged)
+
+    def removed(self, parent, first, last):
+        self.signals.append('remove')
+        del self.rows[first:last+1]
+
+    def moved(self, parent, start, end, destination, row):
+        self.signals.append('move')
+        moving = self.rows[start:end+1]
+        del self.rows[start:end+1]
+        if row > start:
+            row -= len(moving)
+        self.rows[row:row] = moving
+
+    def inserted(self, parent, first, last):
+        self.signals.append('insert')
+        self.rows[first:first] = deepcopy(self.model.patterns[first:last+1])
+
+    def dataChanged(self, topLeft, bottomRight):
+        self.signals.append('change')
+        for i in range(topLeft.row(), bottomRight.row() + 1):
+            self.rows[i] = deepcopy(self.model.patterns[i])
+
+def syncedModel(rows, newRows):
+    model = PatternModel()
+    model.setPatterns(deepcopy(rows))
+    replay = Replay(model)
+    changed = model.updatePatterns(deepcopy(newRows))
+    assert model.patterns == newRows
+    assert replay.rows == newRows
+    return changed, replay.signals
+
+
+def test_nothing_to_do():
+    rows = [pattern('a'), pattern('b'), pattern('a')]
+    assert syncedModel(rows, rows) == (set(), [])
+
+def test_remove():
+    changed, signals = syncedModel([pattern('a'), pattern('b'), pattern('c')], [pattern('a'), pattern('c')])
+    assert (changed, signals) == ({'b'}, ['remove'])
+
+def test_move():
+    changed, signals = syncedModel([pattern('a'), pattern('b'), pattern('c')], [pattern('c'), pattern('a'), pattern('b')])
+    assert (changed, signals) == (set(), ['move'])
+
+def test_insert():
+    changed, signals = syncedModel([pattern('a'), pattern('c')], [pattern('a'), pattern('b'), pattern('c')])
+    assert (changed, signals) == ({'b'}, ['insert'])
+
+def test_change():
+    changed, signals = syncedModel([pattern('a'), pattern('b')], [pattern('a'), pattern('b', notes = 3)])
+    assert (changed, signals) == ({'b'}, ['change'])
+
+def test_clones_by_occurrence():
+    # the second "a" is a clone, changing it must not touch the first one
+    changed, signals = syncedModel([pattern('a'), pattern('a')], [pattern('a'), pattern('a', length = 8)])
+    assert (changed, signals) == ({'a'}, ['change'])
+
+def test_persistent_index_follows_the_row():
+    model = PatternModel()
+    model.setPatterns([pattern('a'), pattern('b'), pattern('c')])
+    index = QPersistentModelIndex(model.createIndex(2, 0))
+    model.updatePatterns([pattern('x'), pattern('c'), pattern('a')])
+    assert index.isValid() and index.row() == 1
+
+def test_random_updates():
+    rnd = random.Random(210)
+    names = 'abcdefg'
+    for _ in range(500):
+        rows = [pattern(rnd.choice(names), rnd.choice([4, 8]), rnd.randint(0, 2)) for _ in range(rnd.randint(0, 8))]
+        newRows = [deepcopy(row) for row in rows if rnd.random() < .7]
+        rnd.shuffle(newRows)
+        for _ in range(rnd.randint(0, 3)):
+            newRows.insert(rnd.randint(0, len(newRows)), pattern(rnd.choice(names), rnd.choice([4, 8]), rnd.randint(0, 2)))
+        for row in newRows:
+            if rnd.random() < .2:
+                row['length'] = 16
+        syncedModel(rows, newRows)
@@ -0,0 +1,37 @@
+# cases GLSLTools.optimize() once got wrong (or has to get right), each with the code that has to come out of it.
+
+import pytest
+
+import GLSLTools
+
+
+cases = [
+    # int / int inside a float expression is still an int division in GLSL
+    ('int division before a float',
+     'float f(float t)\n{\n    return max(0., 1/2*3.);\n}\n',
+     'float f(float t)\n{\n    return max(0., 0.);\n}\n'),
+    ('int division plus a float',
+     'float f(float t)\n{\n    return t * (7/2 + 0.);\n}\n',
+     'float f(float t)\n{\n    return t * 3.;\n}\n'),
+    # the global "scale" must not end up next to the local "scale" of the caller
+    ('global shadowed in the caller',
+     'const float scale = 2.;\nfloat g(float x)\n{\n    return x * scale;\n}\n'
+     + 'float f(float t)\n{\n    float a = 1., scale = 3.;\n    return g(t) + a + scale;\n}\n',
+     'const float scale = 2.;\nfloat g(float x)\n{\n    return x * scale;\n}\n'
+     + 'float f(float t)\n{\n    float a = 1., scale = 3.;\n    return g(t) + a + scale;\n}\n'),
+]
+
+
+@pytest.mark.parametrize('code, expected', [case[1:] for case in cases], ids = [case[0] for case in cases])
+def test_optimize(code, expected):
+    assert GLSLTools.optimize(code)[0] == expected
+
+def test_evaluate_literals():
+    assert GLSLTools.evaluateLiterals('7/2') == '3'
+    assert GLSLTools.evaluateLiterals('-7/2') == '-3'
+    assert GLSLTools.evaluateLiterals('7./2') == '3.5'
+    assert GLSLTools.evaluateLiterals('1+2*3') == '7'
+    # nothing to fold safely
+    assert GLSLTools.evaluateLiterals('1/0') is None
+    assert GLSLTools.evaluateLiterals('010+1') is None
+    assert GLSLTools.evaluateLiterals('2147483647+1') is None
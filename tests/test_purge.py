@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+# GLSLTools.purgeExpendables() against the old aMaySynBuilder.purgeExpendables(), with pytest.
+# run directly, it compares output and speed:
+#   python3 tests/test_purge.py                       a generated shader with 2000 functions
+#   python3 tests/test_purge.py 5000                  ... with 5000 of them
+#   python3 tests/test_purge.py sfx.frag song.glsl    real shaders (without the final purge, e.g. with the templates)
+
+import re
+import sys
+import random
+import timeit
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+import GLSLTools
+
+
+def legacyPurge(code):
+    # aMaySynBuilder.purgeExpendables() as it was, minus the prints
+    purged_code = ''
+    while True:
+        func_list = {}
+        for i,l in enumerate(code.splitlines()):
+            func_head = re.findall(r'(?<=float )\w*(?=[ ]*\(.*\))', l)
+            if func_head:
+                func_list.update({func_head[0]:i})
+
+        expendable = []
+        for f in func_list.keys():
+            if len(re.findall(f + r'[ \n]*\(', code)) == 1:
+                f_from = code.find('float '+f)
+                if f_from == -1: continue
+                f_iter = f_from
+                n_open = 0
+                n_closed = 0
+                while True:
+                    n_open += int(code[f_iter] == '{')
+                    n_closed += int(code[f_iter] == '}')
+                    f_iter += 1
+                    if n_open > 0 and n_closed == n_open: break
+
+                expendable.append(code[f_from:f_iter])
+
+        for e in expendable: code = code.replace(e + '\n', '')
+
+        if code == purged_code:
+            break
+        else:
+            purged_code = code
+
+    return re.sub('\n[\n]*\n', '\n\n', purged_code)
+
+def generateShader(nfunctions, seed = 210):
+    # a bunch of float helpers calling earlier ones, main() only uses some of them - like the synth code does
+    rnd = random.Random(seed)
+    code = ['#version 130\nuniform float iTexSize;\n\n']
+    for f in range(nfunctions):
+        callees = rnd.sample(range(f), min(f, rnd.randint(0, 3)))
+        body = ' + '.join([f'fn{c}(t * {rnd.random():.3f})' for c in callees] + [f'sin({rnd.random():.4f} * t)'])
+        code.append(f'float fn{f}(float t)\n{{\n    float r = {body};\n    if(r > 0.)\n    {{\n        r *= .5;\n    }}\n    return r;\n}}\n\n')
+    used = rnd.sample(range(nfunctions), max(1, nfunctions // 20))
+    code.append('void main()\n{\n    float t = gl_FragCoord.x;\n    gl_FragColor = vec4(' + ' + '.join(f'fn{u}(t)' for u in used) + ');\n}\n')
+    return ''.join(code)
+
+def generateNamedShader(rnd, names):
+    # float and vec2 functions with the given names, calling earlier ones, some of them mentioned in a comment
+    code = ['#version 130\n\n']
+    for i, name in enumerate(names):
+        callees = rnd.sample(names[:i], min(i, rnd.randint(0, 2)))
+        body = ' + '.join([f'{c}(t)' for c in callees] + ['t'])
+        code.append(f"{'float' if rnd.random() < .85 else 'vec2'} {name}(float t)\n{{\n    return {body};\n}}\n\n")
+        if rnd.random() < .1:
+            code.append(f'// {rnd.choice(names)}(t) is not used\n\n')
+    used = rnd.sample(names, rnd.randint(0, len(names)))
+    code.append('void main()\n{\n    gl_FragColor = vec4(' + ' + '.join([f'{u}(1.)' for u in used] + ['0.']) + ');\n}\n')
+    return ''.join(code)
+
+def randomNames(rnd):
+    return list({rnd.choice('abcfg') + ''.join(rnd.choice('abxy') for _ in range(rnd.randint(0, 3))) for _ in range(rnd.randint(1, 12))})
+
+def isPrefixFree(names):
+    return not any(a != b and (b.startswith(a) or b.endswith(a)) for a in names for b in names)
+
+def definitions(code):
+    return re.findall('(?m)^\\w+ (\\w+)\\(float t\\)$', code)
+
+def calls(code):
+    return set(re.findall('(\\w+)\\(t\\)', GLSLTools.maskComments(code)))
+
+
+def test_generated_shader_like_legacy():
+    code = generateShader(300)
+    assert GLSLTools.purgeExpendables(code)[0] == legacyPurge(code)
+
+def test_random_shaders_like_legacy():
+    # as long as no name is the beginning or the end of another one, the old version was right
+    rnd = random.Random(210)
+    for _ in range(2000):
+        names = randomNames(rnd)
+        if not isPrefixFree(names):
+            continue
+        code = generateNamedShader(rnd, names)
+        assert GLSLTools.purgeExpendables(code)[0] == legacyPurge(code)
+
+def test_random_shaders_stay_valid():
+    # with names inside other names, whatever is still called has to be still there, and nothing dead is left over
+    rnd = random.Random(211)
+    for _ in range(2000):
+        names = randomNames(rnd)
+        code = generateNamedShader(rnd, names)
+        purged, removed = GLSLTools.purgeExpendables(code)
+        left = definitions(purged)
+        assert sorted(left + removed) == sorted(names)
+        assert calls(purged) <= set(left)
+        assert set(removed).isdisjoint(calls(purged))
+
+def test_prefix_of_a_used_function():
+    # "ba" is dead, "barfoo" is not. the old version cut "ba" from "float barfoo(" on and broke barfoo
+    code = ('float barfoo(float x)\n{\n    return x;\n}\n\n'
+            'float ba(float x)\n{\n    return x * 2.;\n}\n\n'
+            'void main()\n{\n    gl_FragColor = vec4(barfoo(1.));\n}\n')
+    purged, removed = GLSLTools.purgeExpendables(code)
+    assert removed == ['ba']
+    assert purged == ('float barfoo(float x)\n{\n    return x;\n}\n\n'
+                      'void main()\n{\n    gl_FragColor = vec4(barfoo(1.));\n}\n')
+
+def test_suffix_of_a_used_function():
+    # "foo(" inside "barfoo(" is no call of foo
+    code = ('float foo(float x)\n{\n    return x;\n}\n\n'
+            'float barfoo(float x)\n{\n    return x * 2.;\n}\n\n'
+            'void main()\n{\n    gl_FragColor = vec4(barfoo(1.));\n}\n')
+    purged, removed = GLSLTools.purgeExpendables(code)
+    assert removed == ['foo']
+    assert 'float barfoo(float x)' in purged
+
+def test_dead_chain_and_comments():
+    code = ('float a(float x)\n{\n    return x;\n}\n\n'
+            'float b(float x)\n{\n    return a(x);\n}\n\n'
+            'float c(float x)\n{\n    return x;\n}\n\n'
+            '// c(x) is mentioned here, so it stays\n'
+            'void main()\n{\n    gl_FragColor = vec4(0.);\n}\n')
+    purged, removed = GLSLTools.purgeExpendables(code)
+    assert removed == ['a', 'b']
+    assert 'float c(float x)' in purged and 'float a(' not in purged
+
+def test_prototype_is_a_use():
+    code = ('float a(float x);\n\n'
+            'float a(float x)\n{\n    return x;\n}\n\n'
+            'void main()\n{\n    gl_FragColor = vec4(0.);\n}\n')
+    assert GLSLTools.purgeExpendables(code) == (code, [])
+
+
+def compare(name, code, repeat = 1):
+    legacy = legacyPurge(code)
+    purged, removed = GLSLTools.purgeExpendables(code)
+    same = 'SAME OUTPUT' if legacy == purged else 'DIFFERENT OUTPUT'
+    legacyTime = timeit.timeit(lambda: legacyPurge(code), number = repeat) / repeat
+    newTime = timeit.timeit(lambda: GLSLTools.purgeExpendables(code), number = repeat) / repeat
+    print(f"{name}: {len(code)} chars -> {len(purged)} chars, {len(removed)} functions purged, {same}")
+    print(f"    legacy {legacyTime*1000:.1f}ms, GLSLTools {newTime*1000:.1f}ms ({legacyTime/max(newTime, 1e-9):.0f}x)")
+    return legacy == purged
+
+
+if __name__ == '__main__':
+    files = [arg for arg in sys.argv[1:] if not arg.isdigit()]
+    sizes = [int(arg) for arg in sys.argv[1:] if arg.isdigit()] or ([2000] if not files else [])
+
+    ok = True
+    for size in sizes:
+        ok &= compare(f"generated ({size} functions)", generateShader(size))
+    for file in files:
+        with open(file) as f:
+            ok &= compare(file, f.read(), repeat = 3)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from RenderCache import RenderCache
+
+
+def render(n, value = 0.):
+    return np.full(n, value, dtype = np.float32)
+
+def entries(cache):
+    return sorted(name[:-4] for name in os.listdir(cache.cachedir) if name.endswith('.f32'))
+
+def age(cache, key, seconds):
+    os.utime(cache.fileName(key), (seconds, seconds))
+
+
+def test_store_and_load(tmp_path):
+    cache = RenderCache(str(tmp_path))
+    key = cache.keyOf('void main(){}', b'\x01\x02', 44100, 512, 10.)
+    assert cache.load(key) is None
+    cache.store(key, np.arange(1000, dtype = np.float32))
+    loaded = cache.load(key)
+    assert np.array_equal(loaded, np.arange(1000, dtype = np.float32))
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_key_covers_everything_that_is_rendered():
+    cache = RenderCache()
+    key = cache.keyOf('shader', b'seq', 44100, 512, 10.)
+    assert key == cache.keyOf('shader', b'seq', 44100, 512, 10.)
+    assert len({key,
+                cache.keyOf('shader2', b'seq', 44100, 512, 10.),
+                cache.keyOf('shader', b'seq2', 44100, 512, 10.),
+                cache.keyOf('shader', b'seq', 48000, 512, 10.),
+                cache.keyOf('shader', b'seq', 44100, 256, 10.),
+                cache.keyOf('shader', b'seq', 44100, 512, 11.),
+                cache.keyOf('shader', b'seq', 44100, 512, 10., floatOutput = True)}) == 7
+
+def test_least_recently_used_go_first(tmp_path):
+    # 4000 bytes per render, room for two and a half of them
+    cache = RenderCache(str(tmp_path), budget = 10000)
+    cache.store('a', render(1000))
+    cache.store('b', render(1000))
+    age(cache, 'a', 100)
+    age(cache, 'b', 200)
+    # a load counts as a use
+    cache.load('a')
+    cache.store('c', render(1000))
+    assert entries(cache) == ['a', 'c']
+
+def test_too_large_or_disabled(tmp_path):
+    cache = RenderCache(str(tmp_path), budget = 100)
+    cache.store('large', render(1000))
+    assert not os.path.exists(cache.fileName('large'))
+    assert cache.streamed('large', 4000) is None
+
+    disabled = RenderCache(str(tmp_path), budget = 0)
+    disabled.store('key', render(10))
+    assert disabled.load('key') is None
+    assert RenderCache(None).load('key') is None
+
+def test_streamed_entry(tmp_path):
+    cache = RenderCache(str(tmp_path), budget = 10000)
+    entry = cache.streamed('song', 8000)
+    for block in range(4):
+        entry.write(render(500, block))
+    assert cache.load('song') is None
+    entry.commit()
+    assert np.array_equal(cache.load('song'), np.repeat(np.arange(4, dtype = np.float32), 500))
+
+    # a failed render leaves nothing behind
+    entry = cache.streamed('failed', 8000)
+    entry.write(render(500))
+    entry.discard()
+    assert os.listdir(cache.cachedir) == [os.path.basename(cache.fileName('song'))]
+
+def test_streamed_entry_is_evicted_like_any_other(tmp_path):
+    cache = RenderCache(str(tmp_path), budget = 6000)
+    cache.store('old', render(1000))
+    age(cache, 'old', 100)
+    entry = cache.streamed('new', 4000)
+    entry.write(render(1000))
+    entry.commit()
+    assert entries(cache) == ['new']
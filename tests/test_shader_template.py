@@ -0,0 +1,57 @@
+# ShaderTemplate.substitute() against the chained str.replace() the builder did before, and the TemplateCache.
+
+import os
+import random
+
+from ShaderTemplate import ShaderTemplate, TemplateCache
+
+# the ones aMaySynBuilder fills in
+placeholders = ["//DEFCODE", "//SYNCODE", "//DRUMSYNCODE", "DRUM_INDEX", "//PARAMCODE", "//FILTERCODE", "//LOOPCODE",
+                "//BEATHEADER", "STEREO_DELAY", "LEVEL_SYN", "LEVEL_DRUM"]
+words = ['float', 'x', '= 0.;', '{', '}', 'return', 'uniform', 'vec2', 's +=', '(1.)', '']
+
+
+def chainedReplace(text, values):
+    for placeholder in placeholders:
+        if placeholder in values:
+            text = text.replace(placeholder, values[placeholder])
+    return text
+
+def randomText(rnd, length, placeholderChance):
+    # separated by whitespace, so no placeholder can appear from two pieces coming together
+    pieces = [rnd.choice(placeholders) if rnd.random() < placeholderChance else rnd.choice(words) for _ in range(length)]
+    return ''.join(piece + rnd.choice([' ', '\n']) for piece in pieces)
+
+
+def test_substitute_like_chained_replace():
+    rnd = random.Random(210)
+    for _ in range(1000):
+        text = randomText(rnd, rnd.randint(0, 40), .3)
+        # values may contain any placeholder - the later ones get filled in, the earlier ones stay
+        values = {p: randomText(rnd, rnd.randint(0, 6), .2) for p in placeholders if rnd.random() < .8}
+        assert ShaderTemplate(text, placeholders).substitute(values) == chainedReplace(text, values)
+
+def test_substitute_twice():
+    template = ShaderTemplate('a //DEFCODE b DRUM_INDEX c //DEFCODE', placeholders)
+    assert template.substitute({'//DEFCODE': '1', 'DRUM_INDEX': '2'}) == 'a 1 b 2 c 1'
+    assert template.substitute({'//DEFCODE': '3'}) == 'a 3 b DRUM_INDEX c 3'
+
+def test_without_placeholders():
+    template = ShaderTemplate('void main(){}\n', [])
+    assert template.substitute({'//DEFCODE': 'x'}) == 'void main(){}\n'
+
+def test_cache_rereads_changed_files(tmp_path):
+    filename = str(tmp_path / 'template.frag')
+    with open(filename, 'w') as f:
+        f.write('a //DEFCODE\n')
+    cache = TemplateCache()
+    first = cache.get(filename, placeholders)
+    assert cache.get(filename, placeholders) is first
+    assert cache.text(filename) == 'a //DEFCODE\n'
+
+    with open(filename, 'w') as f:
+        f.write('b //DEFCODE //SYNCODE\n')
+    os.utime(filename, ns = (0, 0))
+    changed = cache.get(filename, placeholders)
+    assert changed is not first
+    assert changed.substitute({'//DEFCODE': '1', '//SYNCODE': '2'}) == 'b 1 2\n'
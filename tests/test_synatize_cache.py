@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+# synatize itself is replaced by counters below, the cache only needs the module to import
+pytest.importorskip('ma2_synatize')
+
+import SynatizeCache as synatizeCacheModule
+from SynatizeCache import SynatizeCache
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = {'synatize': 0, 'synatize_build': 0}
+    def synatize(synFile, stored_randoms = [], reshuffle_randoms = False):
+        calls['synatize'] += 1
+        return (['form'], [{'type': 'main', 'id': 'bass'}], ['kick'], list(stored_randoms), ['param'])
+    def synatize_build(form_list, main_list, param_list, synths, drums):
+        calls['synatize_build'] += 1
+        return ('syncode', 'drumsyncode', 'filtercode', 'paramcode', sorted(synths) + sorted(drums))
+    monkeypatch.setattr(synatizeCacheModule, 'synatize', synatize)
+    monkeypatch.setattr(synatizeCacheModule, 'synatize_build', synatize_build)
+    return calls
+
+@pytest.fixture
+def synFile(tmp_path):
+    synFile = tmp_path / 'song.syn'
+    synFile.write_text('main bass = osc_sin\n')
+    return str(synFile)
+
+
+def test_hits_are_fresh_copies(tmp_path, calls, synFile):
+    cache = SynatizeCache(str(tmp_path / 'cache'))
+    key, first = cache.synatize(synFile)
+    first[1].append('changed by the caller')
+    again, second = cache.synatize(synFile)
+    assert calls['synatize'] == 1
+    assert again == key
+    assert second[1] == [{'type': 'main', 'id': 'bass'}]
+
+def test_disk_hit_survives_a_restart(tmp_path, calls, synFile):
+    key, result = SynatizeCache(str(tmp_path / 'cache')).synatize(synFile)
+    built = SynatizeCache(str(tmp_path / 'cache')).synatize_build(key, *result[:2], result[4], ['I_bass'], ['kick'])
+
+    cache = SynatizeCache(str(tmp_path / 'cache'))
+    assert cache.synatize(synFile) == (key, result)
+    assert cache.synatize_build(key, *result[:2], result[4], ['I_bass'], ['kick']) == built
+    assert calls == {'synatize': 1, 'synatize_build': 1}
+    assert (cache.hits, cache.misses) == (2, 0)
+
+def test_reshuffle_is_never_cached(tmp_path, calls, synFile):
+    cache = SynatizeCache(str(tmp_path / 'cache'))
+    cache.synatize(synFile, reshuffle_randoms = True)
+    cache.synatize(synFile, reshuffle_randoms = True)
+    assert calls['synatize'] == 2
+
+def test_disk_budget_drops_least_recently_used(tmp_path):
+    cache = SynatizeCache(str(tmp_path / 'cache'), budget = 2500)
+    for n in range(4):
+        cache.store(f'entry{n}', bytes(1000))
+        os.utime(os.path.join(cache.cachedir, f'entry{n}.pickle'), (n, n))
+    cache.evict()
+    assert sorted(os.listdir(cache.cachedir)) == ['entry2.pickle', 'entry3.pickle']
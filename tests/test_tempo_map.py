@@ -0,0 +1,72 @@
+# TempoMap against the old aMaySynBuilder.getTimeOfBeat_raw(), which walked through all tempo changes on every call.
+
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from TempoMap import TempoMap, tempoMap
+
+
+def legacyTimeOfBeat(beat, bpmlist):
+    # aMaySynBuilder.getTimeOfBeat_raw() as it was
+    bpmdict = {float(part.split(':')[0]): float(part.split(':')[1]) for part in bpmlist.split()}
+    if beat < 0:
+        return 0
+    if len(bpmdict) == 1:
+        return beat * 60./bpmdict[0]
+    time = 0
+    for b in range(len(bpmdict) - 1):
+        last_B = [*bpmdict][b]
+        next_B = [*bpmdict][b+1]
+        if beat < next_B:
+            return time + (beat - last_B) * 60./ bpmdict[last_B]
+        else:
+            time += (next_B - last_B) * 60./ bpmdict[last_B]
+    return time + (beat - next_B) * 60./ bpmdict[next_B]
+
+def randomBpmString(rnd, ordered = True):
+    beats = [0] + rnd.sample(range(1, 200), rnd.randint(0, 8))
+    if ordered:
+        beats.sort()
+    else:
+        beats = [0] + rnd.sample(beats[1:], len(beats) - 1)
+    return ' '.join(f'{b}:{rnd.randint(60, 200)}' for b in beats)
+
+def probeBeats(rnd, bpmstring):
+    beats = [float(part.split(':')[0]) for part in bpmstring.split()]
+    # on, just before and just after every tempo change, and whatever else
+    return [-1., 0.] + beats + [b - .25 for b in beats] + [b + .25 for b in beats] + [rnd.uniform(-10, 250) for _ in range(20)]
+
+
+@pytest.mark.parametrize('ordered', [True, False], ids = ['sorted', 'unsorted'])
+def test_time_of_beat_like_legacy(ordered):
+    rnd = random.Random(210)
+    for _ in range(300):
+        bpmstring = randomBpmString(rnd, ordered)
+        tempo = TempoMap(bpmstring)
+        for beat in probeBeats(rnd, bpmstring):
+            assert tempo.timeOfBeat(beat) == pytest.approx(legacyTimeOfBeat(beat, bpmstring), abs = 1e-9)
+
+@pytest.mark.parametrize('ordered', [True, False], ids = ['sorted', 'unsorted'])
+def test_times_of_beats_like_legacy(ordered):
+    rnd = random.Random(211)
+    for _ in range(300):
+        bpmstring = randomBpmString(rnd, ordered)
+        beats = probeBeats(rnd, bpmstring)
+        times = TempoMap(bpmstring).timesOfBeats(beats)
+        assert times.tolist() == pytest.approx([legacyTimeOfBeat(beat, bpmstring) for beat in beats], abs = 1e-9)
+
+def test_single_tempo():
+    tempo = TempoMap('0:120')
+    assert tempo.timeOfBeat(8) == legacyTimeOfBeat(8, '0:120') == 4.
+    assert tempo.timeOfBeat(-2) == 0
+
+def test_beat_of_time_inverts():
+    tempo = TempoMap('0:120 16:140 32:90.5 40:175')
+    for beat in [0., 3.5, 16., 20.25, 32., 39.9, 40., 100.]:
+        assert tempo.beatOfTime(tempo.timeOfBeat(beat)) == pytest.approx(beat)
+
+def test_cached_by_string():
+    assert tempoMap('0:120 16:140') is tempoMap('0:120 16:140')
@@ -0,0 +1,91 @@
+from struct import unpack
+
+import pytest
+
+np = pytest.importorskip('numpy')
+wavfile = pytest.importorskip('scipy.io.wavfile')
+
+from WavStreamWriter import WavStreamWriter
+
+
+def samples(frames, channels = 2):
+    return (np.sin(np.arange(frames * channels, dtype = np.float32) * .01) * .9).astype(np.float32)
+
+def writeBlocks(filename, data, blocksize = 1000, **kwargs):
+    writer = WavStreamWriter(str(filename), 44100, **kwargs)
+    for start in range(0, len(data), blocksize):
+        writer.write(data[start : start + blocksize])
+    writer.close()
+    return writer
+
+def chunks(filename):
+    with open(filename, 'rb') as f:
+        content = f.read()
+    found = {}
+    pos = 12
+    while pos + 8 <= len(content):
+        name, size = content[pos:pos+4], unpack('<I', content[pos+4:pos+8])[0]
+        found[name] = (pos + 8, size)
+        pos += 8 + size + size % 2
+    return content, found
+
+
+@pytest.mark.parametrize('sampleFormat, dtype, scale', [('float32', np.float32, 1.), ('int24', np.int32, 2147483648.), ('int16', np.int16, 32768.)])
+def test_roundtrip(tmp_path, sampleFormat, dtype, scale):
+    data = samples(4321)
+    writeBlocks(tmp_path / 'out.wav', data, sampleFormat = sampleFormat, dither = False)
+    samplerate, read = wavfile.read(tmp_path / 'out.wav')
+    assert samplerate == 44100
+    assert read.dtype == dtype
+    assert read.shape == (4321, 2)
+    # int24 comes back scaled up to 32 bits
+    assert np.allclose(read.reshape(-1) / scale, data, atol = 2. / 32768.)
+
+def test_header(tmp_path):
+    writer = writeBlocks(tmp_path / 'out.wav', samples(1000), sampleFormat = 'int16')
+    content, found = chunks(tmp_path / 'out.wav')
+    assert content[:4] == b'RIFF' and content[8:12] == b'WAVE'
+    assert unpack('<I', content[4:8])[0] == len(content) - 8
+    assert list(found) == [b'JUNK', b'fmt ', b'data']
+    assert found[b'data'] == (writer.headerSize(), 4000)
+
+def test_odd_data_size_is_padded(tmp_path):
+    # mono int24: 3 bytes per frame, an odd number of frames gives an odd sized data chunk
+    writer = writeBlocks(tmp_path / 'out.wav', samples(333, channels = 1), channels = 1, sampleFormat = 'int24')
+    content, found = chunks(tmp_path / 'out.wav')
+    assert found[b'data'][1] == 999
+    assert len(content) == writer.headerSize() + 999 + 1
+    assert content[-1:] == b'\x00'
+    # the pad byte is part of the RIFF chunk
+    assert unpack('<I', content[4:8])[0] == len(content) - 8
+    assert wavfile.read(tmp_path / 'out.wav')[1].shape == (333,)
+
+def test_rf64_header(tmp_path):
+    # no 4 GiB of samples needed, the header only depends on the sizes
+    writer = WavStreamWriter(str(tmp_path / 'out.wav'), 44100, sampleFormat = 'float32')
+    writer.dataSize = (5 << 30) + 8
+    writer.writeHeader()
+    writer.file.close()
+    with open(tmp_path / 'out.wav', 'rb') as f:
+        header = f.read(writer.headerSize())
+
+    assert header[:4] == b'RF64' and unpack('<I', header[4:8])[0] == 0xFFFFFFFF and header[8:12] == b'WAVE'
+    assert header[12:16] == b'ds64'
+    size, riffSize, dataSize, frames, tableLength = unpack('<IQQQI', header[16:48])
+    assert (size, riffSize, dataSize, frames, tableLength) == (28, writer.headerSize() - 8 + writer.dataSize, writer.dataSize, writer.dataSize // 8, 0)
+    assert header[-8:] == b'data' + b'\xff\xff\xff\xff'
+    # the fact chunk points to the ds64, too
+    fact = header.index(b'fact')
+    assert unpack('<I', header[fact+8:fact+12])[0] == 0xFFFFFFFF
+
+def test_junk_is_as_large_as_ds64(tmp_path):
+    writer = WavStreamWriter(str(tmp_path / 'out.wav'), 44100)
+    small = writer.file.tell()
+    writer.dataSize = 5 << 30
+    writer.writeHeader()
+    assert writer.file.tell() == small == writer.headerSize()
+    writer.file.close()
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        WavStreamWriter(str(tmp_path / 'out.wav'), 44100, sampleFormat = 'int8')